@@ -0,0 +1,204 @@
+import datetime
+
+# Every summary row is kept for each of these periods, so reports over long ranges read a few weekly rows rather than
+# every day's
+PERIODS = ("day", "week")
+PERIOD_SECONDS = {"day": 86400, "week": 7 * 86400}
+PERIODS_TABLE = "(SELECT 'day' AS `period` UNION ALL SELECT 'week') AS `periods`"
+# Columns reports can be grouped by
+GROUPS = {
+    "printer": ["`printer id`", "`printer type`"],
+    "type": ["`printer type`"]
+}
+COUNTERS = ["started", "completed", "failed", "print seconds", "filament used", "wait seconds"]
+
+STARTED_UPDATE = (
+    "ON DUPLICATE KEY UPDATE `started` = `started` + VALUES(`started`), "
+    "`wait seconds` = `wait seconds` + VALUES(`wait seconds`)"
+)
+FINISHED_UPDATE = (
+    "ON DUPLICATE KEY UPDATE `completed` = `completed` + VALUES(`completed`), "
+    "`failed` = `failed` + VALUES(`failed`), "
+    "`print seconds` = `print seconds` + VALUES(`print seconds`), "
+    "`filament used` = `filament used` + VALUES(`filament used`)"
+)
+
+
+def period_start(time):
+    """SQL for the first day of the day or week a time falls in, for each row of PERIODS_TABLE
+
+    Weeks start on Monday.
+    """
+    return f"IF(`periods`.`period` = 'day', DATE({time}), DATE({time}) - INTERVAL WEEKDAY({time}) DAY)"
+
+
+def started_statement(print_ids):
+    """Count prints which have just started in the current day and week's summaries
+
+    How long each waited in the queue is counted too. Must run after the prints are marked running, so their
+    assigned printer is set.
+
+    Parameters
+    ----------
+    print_ids: list
+
+    Returns
+    -------
+    tuple
+        (query, params)
+    """
+    return (
+        "INSERT INTO `print summaries` (`period`, `start`, `printer id`, `printer type`, `started`, `wait seconds`) "
+        f"SELECT `periods`.`period`, {period_start('CURRENT_TIMESTAMP')}, `assigned printer`, `printer type`, "
+        "COUNT(*), SUM(TIMESTAMPDIFF(SECOND, `added`, CURRENT_TIMESTAMP)) "
+        f"FROM `prints` JOIN {PERIODS_TABLE} "
+        f"WHERE `prints`.`id` IN ({', '.join('?' * len(print_ids))}) "
+        "GROUP BY `periods`.`period`, `assigned printer`, `printer type` "
+        f"{STARTED_UPDATE}",
+        list(print_ids)
+    )
+
+
+def finished_statement(totals):
+    """Count prints which have just finished in the current day and week's summaries
+
+    A print's time and filament are counted in the period it finishes in.
+
+    Parameters
+    ----------
+    totals: dict
+        Printer ID: [seconds printed, prints completed, filament used in grams, prints failed]
+
+    Returns
+    -------
+    tuple
+        (query, params)
+    """
+    cases = ' '.join(['WHEN ? THEN ?'] * len(totals))
+    return (
+        "INSERT INTO `print summaries` (`period`, `start`, `printer id`, `printer type`, `completed`, `failed`, "
+        "`print seconds`, `filament used`) "
+        f"SELECT `periods`.`period`, {period_start('CURRENT_TIMESTAMP')}, `id`, `type`, "
+        f"CASE `id` {cases} END, CASE `id` {cases} END, CASE `id` {cases} END, CASE `id` {cases} END "
+        f"FROM `printers` JOIN {PERIODS_TABLE} "
+        f"WHERE `id` IN ({', '.join('?' * len(totals))}) "
+        f"{FINISHED_UPDATE}",
+        [value for column in (1, 3, 0, 2) for printer_id, total in totals.items()
+         for value in (printer_id, total[column])] + list(totals)
+    )
+
+
+def rebuild_statements():
+    """Statements recreating every summary from the history in the prints table, e.g. after upgrading
+
+    This reads the whole prints table, so is only meant to be run once. Print times are taken from each print's start
+    and finish times, and filament from its estimate, as what the printers reported isn't kept for each print.
+
+    Returns
+    -------
+    list
+        (query, params) of each statement, to run in one transaction
+    """
+    return [
+        ("DELETE FROM `print summaries`", ()),
+        (
+            "INSERT INTO `print summaries` (`period`, `start`, `printer id`, `printer type`, `started`, "
+            "`wait seconds`) "
+            f"SELECT `periods`.`period`, {period_start('`start time`')}, `assigned printer`, MAX(`printer type`), "
+            "COUNT(*), SUM(GREATEST(TIMESTAMPDIFF(SECOND, `added`, `start time`), 0)) "
+            f"FROM `prints` JOIN {PERIODS_TABLE} "
+            "WHERE `start time` IS NOT NULL AND `assigned printer` IS NOT NULL "
+            f"GROUP BY `periods`.`period`, {period_start('`start time`')}, `assigned printer`",
+            ()
+        ),
+        (
+            "INSERT INTO `print summaries` (`period`, `start`, `printer id`, `printer type`, `completed`, `failed`, "
+            "`print seconds`, `filament used`) "
+            f"SELECT `periods`.`period`, {period_start('`finish time`')}, `assigned printer`, MAX(`printer type`), "
+            "SUM(`print status` = 'Complete'), SUM(`print status` = 'Failed'), "
+            "SUM(IF(`print status` = 'Complete', GREATEST(TIMESTAMPDIFF(SECOND, `start time`, `finish time`), 0), 0)), "
+            "SUM(IF(`print status` = 'Complete', IFNULL(`filament estimate`, 0), 0)) "
+            f"FROM `prints` JOIN {PERIODS_TABLE} "
+            "WHERE `print status` IN ('Complete', 'Failed') AND `finish time` IS NOT NULL "
+            "AND `assigned printer` IS NOT NULL "
+            f"GROUP BY `periods`.`period`, {period_start('`finish time`')}, `assigned printer` "
+            f"{FINISHED_UPDATE}",
+            ()
+        )
+    ]
+
+
+def report_query(period, start, end, group):
+    """Query summing the summaries in a range of periods, grouped by printer or printer type
+
+    Parameters
+    ----------
+    period: str
+        One of PERIODS
+    start: datetime.date
+        First day of the range
+    end: datetime.date
+        Last day of the range
+    group: str
+        One of GROUPS
+
+    Returns
+    -------
+    tuple
+        (query, params)
+    """
+    if period == "week":
+        # Include the week the range starts part way through
+        start -= datetime.timedelta(days=start.weekday())
+    columns = ', '.join(GROUPS[group])
+    sums = ', '.join(f"SUM(`{counter}`)" for counter in COUNTERS)
+    return (
+        f"SELECT `start`, {columns}, COUNT(DISTINCT `printer id`), {sums} "
+        "FROM `print summaries` "
+        "WHERE `period` = ? AND `start` BETWEEN ? AND ? "
+        f"GROUP BY `start`, {columns} "
+        f"ORDER BY `start`, {columns}",
+        (period, start, end)
+    )
+
+
+def report_rows(rows, period, group):
+    """Turn the results of report_query into rates ready to serialise as JSON
+
+    Utilisation is the share of the period the printers in each row spent printing, counting only printers which
+    started or finished a print in it.
+    """
+    names = [column.strip('`').replace(' ', '_') for column in GROUPS[group]]
+    report = []
+    for row in rows:
+        start, keys, printers = row[0], row[1:1 + len(names)], row[1 + len(names)]
+        counters = dict(zip(COUNTERS, (float(value or 0) for value in row[2 + len(names):])))
+        finished = counters['completed'] + counters['failed']
+        entry = {'start': start.isoformat() if isinstance(start, datetime.date) else start}
+        entry.update(zip(names, keys))
+        entry.update({
+            'started': int(counters['started']),
+            'completed': int(counters['completed']),
+            'failed': int(counters['failed']),
+            'failure_rate': counters['failed'] / finished if finished else None,
+            'mean_wait': counters['wait seconds'] / counters['started'] if counters['started'] else None,
+            'print_seconds': int(counters['print seconds']),
+            'filament_used': round(counters['filament used'], 1),
+            'utilisation': counters['print seconds'] / (PERIOD_SECONDS[period] * printers) if printers else None
+        })
+        report.append(entry)
+    return report
+
+
+if __name__ == "__main__":
+    try:
+        import QueueInterface
+    except ImportError:
+        from app import QueueInterface
+
+    # Fill the summaries in from the existing history, e.g. after upgrading
+    with QueueInterface.pool.connection() as connection:
+        with connection.transaction():
+            for query, params in rebuild_statements():
+                connection.execute(query, params)
+    print("Print summaries rebuilt")
@@ -0,0 +1,622 @@
+import argparse
+import base64
+import contextlib
+import datetime
+import hashlib
+import http.client
+import http.server
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import wait
+from contextlib import contextmanager
+
+# Only warnings are logged, so logging doesn't skew the results
+logging.basicConfig(filename='Benchmark.log', level=logging.WARNING,
+                    format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
+
+try:
+    import GcodeCache
+    import QueueInterface
+    import Supervisor
+    import Telemetry
+    import httpserver
+except ImportError:
+    from app import GcodeCache
+    from app import QueueInterface
+    from app import Supervisor
+    from app import Telemetry
+    from app import httpserver
+
+import httplib2
+from googleapiclient.http import HttpRequest
+
+PRINTER_TYPE = "Benchmark"
+
+SCHEMA = """
+CREATE TABLE `printers` (
+  `id` INTEGER PRIMARY KEY,
+  `name` TEXT,
+  `type` TEXT,
+  `ip address` TEXT,
+  `api key` TEXT,
+  `total time printed` INTEGER DEFAULT 0,
+  `maintenance time` INTEGER DEFAULT 0,
+  `completed prints` INTEGER DEFAULT 0,
+  `failed prints` INTEGER DEFAULT 0,
+  `total filament used` REAL DEFAULT 0
+);
+CREATE TABLE `prints` (
+  `id` INTEGER PRIMARY KEY,
+  `email address` TEXT,
+  `project type` TEXT,
+  `gcode filename` TEXT,
+  `drive file id` TEXT,
+  `filament estimate` REAL,
+  `printer type` TEXT,
+  `rep check` TEXT,
+  `notes` TEXT,
+  `print status` TEXT DEFAULT 'Pending Check',
+  `assigned printer` INTEGER,
+  `expected duration` DURATION,
+  `added` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  `last updated` TIMESTAMP,
+  `start time` TIMESTAMP,
+  `finish time` TIMESTAMP,
+  `completion time` TIMESTAMP
+);
+CREATE INDEX `queue order` ON `prints` (`print status`, `printer type`, `added`);
+"""
+
+# Stored as seconds, read back as the timedelta MariaDB's TIME columns give
+sqlite3.register_adapter(datetime.timedelta, lambda duration: int(duration.total_seconds()))
+sqlite3.register_converter("DURATION", lambda seconds: datetime.timedelta(seconds=int(seconds)))
+
+
+class QueryCounter:
+    """Thread-safe count of the statements run against the benchmark database"""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            self.count += 1
+
+    def reset(self):
+        with self.lock:
+            count, self.count = self.count, 0
+        return count
+
+
+queries = QueryCounter()
+
+
+class BitXor:
+    """SQLite aggregate matching MariaDB's BIT_XOR"""
+
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= value
+
+    def finalize(self):
+        return self.value
+
+
+class SqliteConnection:
+    """Stand-in for QueueInterface.PooledConnection backed by an SQLite file, counting every statement run
+
+    The queue's SQL is close enough to SQLite's dialect for everything the supervisor does each tick.
+    """
+
+    def __init__(self, path):
+        self.database = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                                        detect_types=sqlite3.PARSE_DECLTYPES)
+        self.database.execute("PRAGMA busy_timeout = 10000")
+        # MariaDB functions the printers table checksum uses, which SQLite doesn't have
+        self.database.create_function("CRC32", 1, lambda value: zlib.crc32(str(value).encode()))
+        self.database.create_function("CONCAT_WS", -1, lambda separator, *values: separator.join(
+            str(value) for value in values if value is not None))
+        self.database.create_aggregate("BIT_XOR", 1, BitXor)
+
+    def execute(self, query, params=()):
+        queries.add()
+        return self.database.execute(query, params).rowcount
+
+    def fetchall(self, query, params=()):
+        queries.add()
+        return self.database.execute(query, params).fetchall()
+
+    def fetchone(self, query, params=()):
+        rows = self.fetchall(query, params)
+        return rows[0] if rows else None
+
+    @contextmanager
+    def transaction(self):
+        self.database.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+            self.database.execute("COMMIT")
+        except Exception:
+            self.database.execute("ROLLBACK")
+            raise
+
+
+def seed_queue(path, printers, prints, file_ids):
+    """Create the benchmark queue database, with every print queued for the simulated printers
+
+    Parameters
+    ----------
+    path: str
+        SQLite file to create
+    printers: list
+        (name, address) of each simulated printer
+    prints: int
+        Number of prints to queue
+    file_ids: list
+        Drive file IDs the prints are spread across
+    """
+    database = sqlite3.connect(path, isolation_level=None)
+    database.execute("PRAGMA journal_mode = WAL")
+    database.executescript(SCHEMA)
+    database.executemany(
+        "INSERT INTO `printers` (`name`, `type`, `ip address`, `api key`) VALUES (?, ?, ?, 'benchmark')",
+        [(name, PRINTER_TYPE, address) for name, address in printers]
+    )
+    added = datetime.datetime.now() - datetime.timedelta(hours=1)
+    database.executemany(
+        "INSERT INTO `prints` (`email address`, `project type`, `gcode filename`, `drive file id`, `printer type`, "
+        "`print status`, `expected duration`, `added`) VALUES (?, 'Module', ?, ?, ?, 'Queued', ?, ?)",
+        [(f"user{index % 20}@example.com", f"print_{index}.gcode", file_ids[index % len(file_ids)], PRINTER_TYPE,
+          3600 + index % 7 * 600, added + datetime.timedelta(seconds=index)) for index in range(prints)]
+    )
+    database.close()
+
+
+def synthetic_gcode(size, seed):
+    """Plausible looking gcode of roughly the given size, the same every time for the same seed"""
+    generator = random.Random(seed)
+    lines = [b"G90", b"M82", b"G28", b"G1 Z0.2 F3000"]
+    length = 0
+    extruded = 0.0
+    while length < size:
+        extruded += generator.random() * 0.05
+        line = b"G1 X%.3f Y%.3f E%.5f F1800" % (generator.random() * 200, generator.random() * 200, extruded)
+        lines.append(line)
+        length += len(line) + 1
+    return b"\n".join(lines) + b"\n"
+
+
+class FakeServer:
+    """HTTP server on a local port, handling each connection on its own thread"""
+
+    def __init__(self, handler):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.address = f"127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeOctoprintHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    FILES_PATH = re.compile(r"^/api/files/local/(.+)$")
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def respond(self, method):
+        printer = self.server.fake
+        path = self.path.split('?')[0]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(printer.latency)
+        if random.random() < printer.failure_rate:
+            self.reply(500, {'error': "Simulated failure"})
+            return
+        with printer.lock:
+            printer.requests += 1
+            printer.update()
+            if method == 'GET' and path == "/api/version":
+                self.reply(200, {'api': "0.1", 'server': "1.3.12", 'text': "OctoPrint 1.3.12"})
+            elif method == 'GET' and path == "/api/printer":
+                self.reply(200, printer.status())
+            elif method == 'GET' and path == "/api/job":
+                self.reply(200, printer.job())
+            elif method == 'GET' and path == f"/api/files/local/{printer.working_folder}":
+                self.reply(200, {'name': printer.working_folder, 'children': printer.children()})
+            elif method == 'POST' and path == "/api/files/local":
+                printer.upload(body)
+                self.reply(201, {'done': True})
+            elif method == 'DELETE' and self.FILES_PATH.match(path):
+                printer.delete(self.FILES_PATH.match(path).group(1))
+                self.reply(204)
+            elif method == 'POST' and path == "/api/job":
+                printer.state = "Cancelling"
+                self.reply(204)
+            else:
+                self.reply(404, {'error': "Not found"})
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def do_DELETE(self):
+        self.respond('DELETE')
+
+
+class FakeOctoprint(FakeServer):
+    """In-process stand-in for one printer's Octoprint server
+
+    Implements just the parts of the REST API the supervisor and web server use. Uploaded prints run for a set time,
+    then complete or fail, and the printer is operational again once the finished file is removed.
+    """
+
+    UPLOAD_FIELD = re.compile(rb'name="(\w+)"(?:; filename="([^"]*)")?\r\n(?:[^\r\n]+\r\n)*\r\n')
+
+    def __init__(self, working_folder, latency=0.0, failure_rate=0.0, print_time=1.0, print_failure_rate=0.0):
+        """
+        Args:
+            working_folder: String
+                Folder the supervisor puts prints in
+            latency: float
+                Seconds added before every response
+            failure_rate: float
+                Fraction of requests answered with a server error
+            print_time: float
+                Seconds each print takes
+            print_failure_rate: float
+                Fraction of prints which fail
+        """
+        self.working_folder = working_folder
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.print_time = print_time
+        self.print_failure_rate = print_failure_rate
+        self.lock = threading.Lock()
+        self.state = "Operational"
+        self.current = None  # Name of the file being printed
+        self.finishes = None
+        self.folder = {}  # Name: whether its last print succeeded
+        self.requests = 0
+        self.uploads = []  # (time received, filename, size) of each upload
+        super().__init__(FakeOctoprintHandler)
+
+    def update(self):
+        if self.current is not None and time.monotonic() >= self.finishes:
+            if self.current in self.folder:
+                self.folder[self.current] = random.random() >= self.print_failure_rate
+            self.current = None
+            self.state = "Operational"
+
+    def status(self):
+        temperature = {
+            'bed': {'actual': 60.0 if self.current else 22.0, 'target': 60.0 if self.current else 0.0},
+            'tool0': {'actual': 210.0 if self.current else 23.0, 'target': 210.0 if self.current else 0.0}
+        }
+        return {'state': {'text': self.state}, 'temperature': temperature}
+
+    def job(self):
+        if self.current is None:
+            return {'job': {'file': {'name': None}}, 'progress': {'completion': None, 'printTimeLeft': None}}
+        remaining = max(0.0, self.finishes - time.monotonic())
+        return {'job': {'file': {'name': self.current}},
+                'progress': {'completion': 100 * (1 - remaining / self.print_time), 'printTimeLeft': int(remaining)}}
+
+    def children(self):
+        return [{'name': name, 'prints': {'success': success, 'last': {'printTime': self.print_time}},
+                 'gcodeAnalysis': {'filament': {'tool0': {'length': 1000.0}}}}
+                for name, success in self.folder.items()]
+
+    def upload(self, body):
+        fields = {}
+        filename = None
+        for match in self.UPLOAD_FIELD.finditer(body):
+            end = body.find(b"\r\n--", match.end())
+            fields[match.group(1).decode()] = body[match.end():end]
+            if match.group(2) is not None:
+                filename = match.group(2).decode()
+        self.uploads.append((time.monotonic(), filename, len(fields.get('file', b""))))
+        if fields.get('path', b"").decode() == self.working_folder:
+            self.folder[filename] = False
+        if fields.get('print') == b"true":
+            self.current = filename
+            self.finishes = time.monotonic() + self.print_time
+            self.state = "Printing"
+
+    def delete(self, path):
+        self.folder.pop(path.split('/')[-1], None)
+
+
+class FakeDriveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        drive = self.server.fake
+        content = drive.files.get(self.path.split('/')[-1])
+        time.sleep(drive.latency)
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = 0, len(content) - 1
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get('Range', ''))
+        if match:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(content) - 1)
+        self.send_response(206 if match else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Range', f"bytes {start}-{end}/{len(content)}")
+        self.end_headers()
+        self.wfile.write(content[start:end + 1])
+
+
+class FakeDriveCall:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeDriveFiles:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def get(self, fileId, fields=None):
+        content = self.drive.files[fileId]
+        return FakeDriveCall({'id': fileId, 'md5Checksum': hashlib.md5(content).hexdigest(), 'size': str(len(content))})
+
+    def get_media(self, fileId):
+        return HttpRequest(httplib2.Http(), None, f"http://{self.drive.address}/media/{fileId}")
+
+
+class FakeDriveService:
+    """Just enough of a Drive v3 service for metadata and media downloads"""
+
+    def __init__(self, drive):
+        self.drive = drive
+
+    def files(self):
+        return FakeDriveFiles(self.drive)
+
+
+class FakeDrive(FakeServer):
+    """Stand-in for Google Drive, serving gcode files from memory over a local media endpoint"""
+
+    def __init__(self, files, latency=0.0):
+        """
+        Args:
+            files: dict
+                File ID: content
+            latency: float
+                Seconds added before every download request
+        """
+        self.files = files
+        self.latency = latency
+        super().__init__(FakeDriveHandler)
+
+    def service(self):
+        return FakeDriveService(self)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class QuietAuthHandler(httpserver.AuthHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark_dashboard(supervisor, directory, clients, duration):
+    """Measure how many status requests a second the web server answers, from a poller over the same printers
+
+    Returns
+    -------
+    float
+        Requests per second
+    """
+    queue = supervisor.queue_factory()
+    telemetry = Telemetry.TelemetryStore(os.path.join(directory, "telemetry"), [[0, 100]], 100)
+    poller = httpserver.StatusPoller(queue, telemetry, 3600, Supervisor.config['supervisor']['poll_workers'])
+    poller.refresh_printers(queue.get_all_printer_details())
+    poller.start()
+    while json.loads(poller.snapshot)['updated'] is None:
+        time.sleep(0.05)
+    httpserver.poller = poller
+    httpserver.telemetry = telemetry
+    httpserver.key = base64.b64encode(b"benchmark:benchmark")
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), QuietAuthHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    counts = []
+    deadline = time.monotonic() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+        headers = {'Authorization': f"Basic {httpserver.key.decode()}"}
+        count = 0
+        while time.monotonic() < deadline:
+            connection.request('GET', "/api/status", headers=headers)
+            connection.getresponse().read()
+            count += 1
+        connection.close()
+        counts.append(count)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    server.shutdown()
+    server.server_close()
+    return sum(counts) / elapsed
+
+
+def run_tick(supervisor):
+    """Run one supervisor tick to completion, including the dispatches it starts
+
+    Returns
+    -------
+    tuple
+        (monotonic time the tick started, database queries made)
+    """
+    queries.reset()
+    started = time.monotonic()
+    # Dispatches report each print on stdout, which would swamp the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        supervisor.check_printer_states()
+        for dispatch in list(supervisor.dispatches.values()):
+            dispatch.result()
+        supervisor.commit_work()
+    return started, queries.reset()
+
+
+def benchmark_farm(count, args):
+    """Simulate a farm of printers, printing the measurements
+
+    Parameters
+    ----------
+    count: int
+        Number of printers
+    args: argparse.Namespace
+        Command line options
+    """
+    directory = tempfile.mkdtemp(prefix="benchmark_")
+    working_folder = Supervisor.config['printers']['working_folder']
+    printers = [FakeOctoprint(working_folder, args.latency, args.failure_rate, args.print_time, args.print_failure_rate)
+                for _ in range(count)]
+    files = {f"file{index}": synthetic_gcode(args.file_size, index) for index in range(args.files)}
+    drive = FakeDrive(files, args.drive_latency)
+    database = os.path.join(directory, "queue.sqlite")
+    seed_queue(database, [(f"Printer {index}", printer.address) for index, printer in enumerate(printers)],
+               count * args.prints_per_printer, list(files))
+
+    pool = QueueInterface.ConnectionPool(QueueInterface.config['queue']['pool_size'], SqliteConnection,
+                                         path=database)
+    cache = GcodeCache.GcodeCache(os.path.join(directory, "gcode_cache"), 1024 * 1024 * 1024)
+
+    class BenchmarkQueue(QueueInterface.QueueInterface):
+        """Queue interface using the simulated Drive and the SQLite queue instead of real accounts"""
+
+        def __init__(self):
+            self.service = drive.service()
+            self.mail_service = None
+            self.pool = pool
+            self.cache = cache
+
+        def release_stale_claims(self, exclude=()):
+            # Uses MariaDB's interval syntax, and a freshly seeded queue can't have stale claims anyway
+            return 0
+
+    started = time.monotonic()
+    supervisor = Supervisor.Supervisor(BenchmarkQueue)
+    startup = time.monotonic() - started
+    # Printers are connected in the background, so the farm is only ready once every connection has finished
+    wait(list(supervisor.polls.values()))
+    ready = time.monotonic() - started
+
+    sweeps = []
+    for _ in range(args.sweeps):
+        started = time.monotonic()
+        supervisor.update_printer_states(True)
+        sweeps.append(time.monotonic() - started)
+
+    # First tick starts a print on every printer
+    uploads = {printer: len(printer.uploads) for printer in printers}
+    started, start_queries = run_tick(supervisor)
+    latencies = [printer.uploads[uploads[printer]][0] - started for printer in printers
+                 if len(printer.uploads) > uploads[printer]]
+
+    # Second tick, once they've all finished, records the results and starts the next prints
+    time.sleep(args.print_time)
+    supervisor.update_printer_states(True)
+    _, finish_queries = run_tick(supervisor)
+
+    throughput = benchmark_dashboard(supervisor, directory, args.clients, args.duration)
+
+    print(f"{count:>8} {startup:>9.2f} {ready:>7.2f} {statistics.mean(sweeps):>8.3f} {len(latencies):>7} "
+          f"{1000 * percentile(latencies, 0.5):>8.0f} {1000 * percentile(latencies, 0.95):>8.0f} "
+          f"{start_queries:>10} {finish_queries:>11} {throughput:>10.0f}")
+
+    for listener in supervisor.listeners.values():
+        listener.stop()
+    for printer in printers:
+        printer.close()
+    drive.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the supervisor, queue and web server against simulated "
+                                                 "printers, Google Drive and an SQLite queue. Run from the app folder.")
+    parser.add_argument('--printers', type=int, nargs='+', default=[10, 50, 100, 500],
+                        help="Farm sizes to simulate")
+    parser.add_argument('--latency', type=float, default=0.01, help="Seconds each Octoprint response takes")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help="Fraction of Octoprint requests which fail")
+    parser.add_argument('--print-time', type=float, default=1.0, help="Seconds each simulated print takes")
+    parser.add_argument('--print-failure-rate', type=float, default=0.1, help="Fraction of prints which fail")
+    parser.add_argument('--drive-latency', type=float, default=0.05,
+                        help="Seconds each Drive download request takes")
+    parser.add_argument('--files', type=int, default=5, help="Number of distinct gcode files in the queue")
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help="Size of each gcode file in bytes")
+    parser.add_argument('--prints-per-printer', type=int, default=3, help="Prints queued for each printer")
+    parser.add_argument('--sweeps', type=int, default=3, help="Status sweeps averaged")
+    parser.add_argument('--clients', type=int, default=8, help="Simultaneous dashboard clients")
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds to run the dashboard clients for")
+    args = parser.parse_args()
+
+    # Keep background work from skewing the measurements - event listeners fall back to polling, which is measured
+    Supervisor.config['supervisor']['event_reconnect_interval'] = 3600
+    Supervisor.config['cache']['prefetch_count'] = 0
+    Supervisor.config['cache']['prefetch_interval'] = 3600
+    Supervisor.config['analyser']['interval'] = 3600
+    # The simulated queue has no email outbox or summary tables
+    Supervisor.config['email']['notifications'] = False
+    QueueInterface.config['email']['notifications'] = False
+    QueueInterface.config['analytics']['summaries'] = False
+
+    print(f"{'Printers':>8} {'Startup':>9} {'Ready':>7} {'Sweep':>8} {'Started':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'Start SQL':>10} {'Finish SQL':>11} {'Status/s':>10}")
+    for count in args.printers:
+        benchmark_farm(count, args)
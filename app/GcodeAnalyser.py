@@ -0,0 +1,293 @@
+import datetime
+import logging
+import math
+import os
+import re
+import threading
+import time
+import warnings
+
+import numpy as np
+
+try:
+    import GcodeStream
+except ImportError:
+    from app import GcodeStream
+
+# Commands the estimate depends on, with their arguments up to any comment. Every other line is skipped by the regex
+# engine without reaching Python
+COMMAND = re.compile(rb'^[ \t]*(?:N\d+[ \t]+)?(G0*[0-4]|G28|G9[0-2]|M8[23]|M204|T\d+)(?![\d.])([^;\n]*)', re.M)
+MOVES = {b'G0', b'G1', b'G2', b'G3', b'G00', b'G01', b'G02', b'G03'}
+WORD = re.compile(rb'([A-Z])[ \t]*([-+]?[\d.]+)')
+LETTERS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+IS_LETTER = np.zeros(256, dtype=bool)
+IS_LETTER[list(LETTERS)] = True
+# Leaves just the numbers of each word, for numpy to parse
+NUMBERS_ONLY = bytes.maketrans(LETTERS + b'\r\n\t', b' ' * (len(LETTERS) + 3))
+
+
+def filament_weight(length, diameter, density):
+    """Convert a length of filament in mm into grams
+
+    Parameters
+    ----------
+    length: float
+        Length of filament in mm
+    diameter: float
+        Filament diameter in mm
+    density: float
+        Density of the filament material in g/cm^3
+    """
+    return math.pi * (diameter / 2) ** 2 * length / 1000 * density
+
+
+def fill_forward(values, start):
+    """Replace each NaN with the last value before it, or start if there isn't one"""
+    values = np.concatenate(([start], values))
+    index = np.where(np.isnan(values), 0, np.arange(len(values)))
+    return values[np.maximum.accumulate(index)][1:]
+
+
+def parse_words(lines):
+    """Split a run of lines of arguments into their words
+
+    Parameters
+    ----------
+    lines: list
+        Arguments of each line, as bytes
+
+    Returns
+    -------
+    tuple
+        numpy arrays of the letter, line number and value of every word
+    """
+    text = b"\n".join(lines)
+    characters = np.frombuffer(text, dtype=np.uint8)
+    newlines = np.flatnonzero(characters == ord('\n'))
+    starts = np.flatnonzero(IS_LETTER[characters])
+    try:
+        with warnings.catch_warnings():
+            # Older versions of numpy only warn about anything they can't parse
+            warnings.simplefilter('error', DeprecationWarning)
+            values = np.fromstring(text.translate(NUMBERS_ONLY), sep=" ")
+    except (ValueError, DeprecationWarning):
+        values = None
+    if values is None or len(values) != len(starts):
+        # Some words are malformed, so fall back to picking out the well formed ones one by one
+        matches = list(WORD.finditer(text))
+        starts = np.array([match.start() for match in matches], dtype=np.int64)
+        values = np.array([float(match.group(2)) for match in matches])
+    return characters[starts], np.searchsorted(newlines, starts), values
+
+
+def column(words, count, axis):
+    """Values an axis is given on each of a run of lines, NaN where it isn't"""
+    letters, lines, values = words
+    given = letters == axis
+    result = np.full(count, np.nan)
+    result[lines[given]] = values[given]
+    return result
+
+
+class GcodeAnalyser:
+    """Estimates the print time and filament use of a gcode file, fed to it one chunk at a time
+
+    Moves are processed in bulk with numpy, so memory use depends on the chunk size rather than the size of the file.
+    Each move is timed with a trapezoidal speed profile, entering and leaving at a junction speed based on the angle
+    to its neighbours, which accounts for acceleration without simulating any particular firmware's planner. Arcs are
+    treated as straight lines.
+    """
+
+    def __init__(self, acceleration, feedrate):
+        """
+        Args:
+            acceleration: float
+                Acceleration in mm/s^2 until the gcode sets its own with M204
+            feedrate: float
+                Feedrate in mm/min until the gcode sets its own
+        """
+        self.acceleration = acceleration
+        self.feedrate = feedrate
+        self.position = dict.fromkeys(b'XYZE', 0.0)
+        self.absolute = True
+        self.absolute_extrusion = True
+        self.tool = 0
+        self.duration = 0.0
+        self.filament = {}  # Tool number: net length of filament extruded in mm
+        self.remainder = b""
+
+    def feed(self, chunk):
+        """Analyse the next chunk of the file"""
+        data = self.remainder + chunk
+        end = data.rfind(b"\n") + 1
+        self.remainder = data[end:]
+        self.analyse(data[:end])
+
+    def finish(self):
+        """Analyse whatever is left after the last chunk
+
+        Returns
+        -------
+        tuple
+            (duration in seconds, {tool number: filament length in mm})
+        """
+        self.analyse(self.remainder + b"\n")
+        self.remainder = b""
+        return float(self.duration), {tool: float(length) for tool, length in self.filament.items()}
+
+    def analyse(self, data):
+        matches = COMMAND.findall(data)
+        if not matches:
+            return
+        commands, arguments = zip(*matches)
+        start = 0
+        for index in [index for index, command in enumerate(commands) if command not in MOVES]:
+            self.moves(arguments[start:index])
+            self.command(commands[index], arguments[index])
+            start = index + 1
+        self.moves(arguments[start:])
+
+    def command(self, command, arguments):
+        """Apply a command which changes the state moves are interpreted in"""
+        words = {letter[0]: float(value) for letter, value in WORD.findall(arguments)}
+        if command in (b'G90', b'G91'):
+            self.absolute = self.absolute_extrusion = command == b'G90'
+        elif command in (b'M82', b'M83'):
+            self.absolute_extrusion = command == b'M82'
+        elif command == b'G92':
+            for axis in (words or dict.fromkeys(b'XYZE', 0.0)):
+                if axis in self.position:
+                    self.position[axis] = words.get(axis, 0.0)
+        elif command == b'G28':
+            for axis in [axis for axis in b'XYZ' if axis in words] or b'XYZ':
+                self.position[axis] = 0.0
+        elif command in (b'G4', b'G04'):
+            self.duration += words.get(ord('S'), 0) + words.get(ord('P'), 0) / 1000
+        elif command == b'M204':
+            self.acceleration = words.get(ord('S'), words.get(ord('P'), self.acceleration))
+        elif command.startswith(b'T'):
+            self.tool = int(command[1:])
+
+    def moves(self, lines):
+        """Time a run of consecutive moves, and add up the filament they extrude"""
+        if not lines:
+            return
+        words = parse_words(lines)
+        deltas = []
+        for axis in b'XYZ':
+            values = column(words, len(lines), axis)
+            if self.absolute:
+                positions = fill_forward(values, self.position[axis])
+            else:
+                positions = self.position[axis] + np.cumsum(np.nan_to_num(values))
+            deltas.append(np.diff(positions, prepend=self.position[axis]))
+            self.position[axis] = positions[-1]
+
+        extrusion = column(words, len(lines), ord('E'))
+        if self.absolute_extrusion:
+            final = fill_forward(extrusion, self.position[ord('E')])[-1]
+        else:
+            final = self.position[ord('E')] + np.nansum(extrusion)
+        # Retractions are undone before extruding again, so the net change is the filament used
+        self.filament[self.tool] = self.filament.get(self.tool, 0.0) + final - self.position[ord('E')]
+        self.position[ord('E')] = final
+
+        feedrates = fill_forward(column(words, len(lines), ord('F')), self.feedrate)
+        self.feedrate = feedrates[-1]
+        speed = np.maximum(feedrates / 60, 1e-3)
+        deltas = np.array(deltas)
+        distance = np.sqrt((deltas ** 2).sum(axis=0))
+        moving = distance > 0
+        if not moving.any():
+            return
+        distance, speed, deltas = distance[moving], speed[moving], deltas[:, moving]
+
+        # Moves in the same direction carry on at full speed, ones at right angles or sharper stop in between
+        directions = deltas / distance
+        cosines = np.clip((directions[:, :-1] * directions[:, 1:]).sum(axis=0), 0, 1)
+        junctions = np.minimum(speed[:-1], speed[1:]) * cosines
+        entry = np.concatenate(([0.0], junctions))
+        exit = np.concatenate((junctions, [0.0]))
+
+        acceleration = self.acceleration
+        accelerating = (speed ** 2 - entry ** 2) / (2 * acceleration)
+        decelerating = (speed ** 2 - exit ** 2) / (2 * acceleration)
+        cruising = distance - accelerating - decelerating
+        # Moves too short to reach full speed peak part way through instead
+        peak = np.maximum(np.sqrt((2 * acceleration * distance + entry ** 2 + exit ** 2) / 2), np.maximum(entry, exit))
+        times = np.where(cruising >= 0,
+                         (2 * speed - entry - exit) / acceleration + cruising / speed,
+                         (2 * peak - entry - exit) / acceleration)
+        self.duration += times.sum()
+
+
+def analyse(chunks, acceleration, feedrate):
+    """Estimate the print time and filament use of a gcode file
+
+    Parameters
+    ----------
+    chunks: iterable
+        Chunks of bytes making up the file
+    acceleration: float
+        Default acceleration in mm/s^2
+    feedrate: float
+        Default feedrate in mm/min
+
+    Returns
+    -------
+    tuple
+        (duration in seconds, {tool number: filament length in mm})
+    """
+    analyser = GcodeAnalyser(acceleration, feedrate)
+    for chunk in chunks:
+        analyser.feed(chunk)
+    return analyser.finish()
+
+
+class Analyser(threading.Thread):
+    """Background thread filling in the expected duration and filament estimate of prints waiting in the queue
+
+    Prints are analysed before they are started, so the scheduler can work from real numbers.
+    """
+
+    def __init__(self, queue, config):
+        """
+        Args:
+            queue: QueueInterface
+                Interface used only by this thread, as the Drive client isn't thread-safe
+            config: dict
+                Analyser section of config.yml
+        """
+        super().__init__(name="Analyser", daemon=True)
+        self.queue = queue
+        self.config = config
+        self.failed = set()  # Prints which couldn't be analysed, so aren't tried again
+
+    def analyse_print(self, print_id, file_id):
+        # Read through the cache, as the print will need the file again once started and it's only fetched once
+        path = self.queue.cache.get(self.queue.service, file_id)
+        chunks, size = GcodeStream.file_chunks(open(path, 'rb')), os.path.getsize(path)
+        started = time.monotonic()
+        duration, filament = analyse(chunks, self.config['acceleration'], self.config['feedrate'])
+        weight = filament_weight(sum(filament.values()), self.config['filament_diameter'],
+                                 self.config['filament_density'])
+        logging.debug(f"Analysed print ID#{print_id} ({size} bytes) in {time.monotonic() - started:.1f}s: "
+                      f"{duration:.0f}s, {filament}mm")
+        self.queue.set_estimates(print_id, datetime.timedelta(seconds=round(duration)), round(weight, 1))
+
+    def run(self):
+        while True:
+            try:
+                unanalysed = self.queue.get_unanalysed_prints(self.config['batch_size'] + len(self.failed))
+            except Exception as e:
+                logging.warning(f"Checking for prints to analyse failed: {e}")
+                unanalysed = []
+            for print_id, file_id in unanalysed:
+                if print_id in self.failed:
+                    continue
+                try:
+                    self.analyse_print(print_id, file_id)
+                except Exception as e:
+                    logging.warning(f"Analysing print ID#{print_id} failed: {e}")
+                    self.failed.add(print_id)
+            time.sleep(self.config['interval'])
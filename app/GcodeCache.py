@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from googleapiclient.http import MediaIoBaseDownload
+
+
+class HashingWriter:
+    """File wrapper which keeps an MD5 hash of everything written through it"""
+
+    def __init__(self, file):
+        self.file = file
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.file.write(data)
+
+
+class GcodeCache:
+    """Size-bounded on-disk cache of gcode files from Google Drive, evicting the least recently used first
+
+    Files are keyed by Drive file ID and MD5 checksum, so a file replaced in Drive is downloaded again rather than
+    served stale.
+    """
+
+    def __init__(self, directory, max_size):
+        """
+        Args:
+            directory: String
+                Folder to keep cached files in, created if missing
+            max_size: int
+                Total size in bytes cached files are trimmed down to
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # Filename: size, least recently used first
+        self.size = 0
+        self.downloading = {}  # Filename: Event set once the download finishes, so each file is only fetched once
+
+        os.makedirs(directory, exist_ok=True)
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime):
+            if entry.name.endswith(".part"):
+                # Left behind by an interrupted download
+                os.remove(entry.path)
+            elif entry.is_file():
+                self.entries[entry.name] = entry.stat().st_size
+                self.size += entry.stat().st_size
+
+    def get(self, service, file_id):
+        """Get the cached copy of a Drive file, downloading it first if not already cached
+
+        Parameters
+        ----------
+        service: googleapiclient.discovery.Resource
+            Drive v3 service to download with
+        file_id: str
+            Drive file ID
+
+        Returns
+        -------
+        str
+            Path to the cached file, which must not be modified
+        """
+        checksum = service.files().get(fileId=file_id, fields="md5Checksum").execute()['md5Checksum']
+        name = f"{file_id}-{checksum}.gcode"
+        while True:
+            with self.lock:
+                if name in self.entries:
+                    self.entries.move_to_end(name)
+                    # Recency is kept in the modification time so it survives restarts
+                    os.utime(os.path.join(self.directory, name))
+                    logging.debug(f"Cache hit for {name}")
+                    return os.path.join(self.directory, name)
+                download_finished = self.downloading.get(name)
+                if download_finished is None:
+                    download_finished = self.downloading[name] = threading.Event()
+                    break
+            # Another thread is already downloading this file - wait for it, then check again in case it failed
+            download_finished.wait()
+
+        try:
+            size = self.download(service, file_id, checksum, name)
+            with self.lock:
+                self.entries[name] = size
+                self.size += size
+                self.evict()
+        finally:
+            with self.lock:
+                del self.downloading[name]
+            download_finished.set()
+        return os.path.join(self.directory, name)
+
+    def open(self, file_id, checksum):
+        """Open the cached copy of a file for reading, without downloading it if it isn't cached
+
+        The open file stays readable even if the cache later evicts it.
+
+        Parameters
+        ----------
+        file_id: str
+            Drive file ID
+        checksum: str
+            MD5 checksum of the current version of the file in Drive
+
+        Returns
+        -------
+        file
+            Binary file object, or None if not cached
+        """
+        name = f"{file_id}-{checksum}.gcode"
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries.move_to_end(name)
+            os.utime(os.path.join(self.directory, name))
+            logging.debug(f"Cache hit for {name}")
+            return open(os.path.join(self.directory, name), 'rb')
+
+    def download(self, service, file_id, checksum, name):
+        """Download a file from Drive into the cache, verifying its checksum
+
+        Returns
+        -------
+        int
+            Size of the downloaded file in bytes
+        """
+        partial = os.path.join(self.directory, name + ".part")
+        request = service.files().get_media(fileId=file_id)
+        try:
+            with open(partial, 'wb') as fh:
+                writer = HashingWriter(fh)
+                downloader = MediaIoBaseDownload(writer, request)
+                done = False
+                while done is False:
+                    status, done = downloader.next_chunk()
+                    logging.debug(f"Caching {name}, status {status}")
+            if writer.md5.hexdigest() != checksum:
+                raise IOError(f"Checksum mismatch downloading {file_id}")
+            os.replace(partial, os.path.join(self.directory, name))
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return os.path.getsize(os.path.join(self.directory, name))
+
+    def evict(self):
+        """Remove least recently used files until the cache fits its size limit, always keeping the newest file
+
+        Must be called with the lock held
+        """
+        while self.size > self.max_size and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            os.remove(os.path.join(self.directory, name))
+            self.size -= size
+            logging.debug(f"Evicted {name} from cache")
+
+
+class Prefetcher(threading.Thread):
+    """Background thread keeping the next few queued prints for each printer type in the cache
+
+    Printers which finish a print can then start the next one without waiting on a download from Drive.
+    """
+
+    def __init__(self, queue, printer_types, count, interval):
+        """
+        Args:
+            queue: QueueInterface
+                Interface used only by this thread, as the Drive client isn't thread-safe
+            printer_types: callable
+                Returns the printer types currently in use
+            count: int
+                Number of upcoming prints to cache for each printer type
+            interval: float
+                Seconds between checks of the queue
+        """
+        super().__init__(name="Prefetcher", daemon=True)
+        self.queue = queue
+        self.printer_types = printer_types
+        self.count = count
+        self.interval = interval
+
+    def run(self):
+        while True:
+            for printer_type in self.printer_types():
+                try:
+                    for print_id, file_id, _ in self.queue.get_queued_prints(printer_type, self.count):
+                        self.queue.cache.get(self.queue.service, file_id)
+                except Exception as e:
+                    # Prefetching is only an optimisation, so just try again next time
+                    logging.warning(f"Prefetching {printer_type} prints failed: {e}")
+            time.sleep(self.interval)
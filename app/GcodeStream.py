@@ -0,0 +1,192 @@
+import io
+import logging
+import uuid
+
+from googleapiclient.http import MediaIoBaseDownload
+
+try:
+    import Metrics
+except ImportError:
+    from app import Metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+upload_seconds = Metrics.Histogram("upload_seconds", "Time taken to upload a file to an Octoprint server")
+upload_bytes = Metrics.Counter("upload_bytes_total", "Bytes uploaded to Octoprint servers")
+
+
+def drive_chunks(service, file_id, chunk_size=CHUNK_SIZE):
+    """Download a file from Google Drive one chunk at a time, without writing it to disk
+
+    Parameters
+    ----------
+    service: googleapiclient.discovery.Resource
+        Drive v3 service to download with
+    file_id: str
+        Drive file ID
+    chunk_size: int
+        Bytes requested from Drive at a time
+
+    Yields
+    ------
+    bytes
+        Successive chunks of the file
+    """
+    buffer = io.BytesIO()
+    downloader = MediaIoBaseDownload(buffer, service.files().get_media(fileId=file_id), chunksize=chunk_size)
+    done = False
+    while done is False:
+        status, done = downloader.next_chunk()
+        logging.debug(f"Streaming {file_id}, status {status}")
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def file_chunks(file, chunk_size=CHUNK_SIZE):
+    """Read an already open binary file one chunk at a time, closing it once finished"""
+    with file:
+        chunk = file.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = file.read(chunk_size)
+
+
+def add_job_markers(chunks, size, print_id):
+    """Show the print ID on the printer's display while printing, and pause at the end of the print
+
+    The pause lets the user confirm completion or failure before the next print is started.
+
+    Parameters
+    ----------
+    chunks: iterable
+        Chunks of the original gcode
+    size: int
+        Total size of the original gcode in bytes
+    print_id: int
+        ID of the print, shown on the display
+
+    Returns
+    -------
+    tuple
+        (iterable of chunks, total size in bytes) of the modified gcode
+    """
+    banner = f"M117 ID#{print_id}\n".encode()
+    pause = b"\nM0; Pause to allow user to confirm completion or failure\n"
+
+    def transformed():
+        yield banner
+        yield from chunks
+        yield pause
+
+    return transformed(), len(banner) + size + len(pause)
+
+
+class MultipartUpload:
+    """File-like multipart/form-data request body, reading the file content lazily from an iterable of chunks
+
+    The total length is known up front so the body can be sent with a Content-Length, one read at a time, rather than
+    being built in memory as requests would for a normal file upload.
+    """
+
+    def __init__(self, filename, chunks, size, fields):
+        """
+        Args:
+            filename: String
+                Name given to the uploaded file
+            chunks: iterable
+                Chunks of bytes making up the file
+            size: int
+                Total size of the file in bytes, which the chunks must add up to
+            fields: dict
+                Other form fields sent before the file
+        """
+        self.boundary = uuid.uuid4().hex
+        head = b"".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            for name, value in fields.items()
+        )
+        head += (f'--{self.boundary}\r\n'
+                 f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.length = len(head) + size + len(tail)
+        self.size = size
+        self.sent = 0
+        self.parts = self.body(head, chunks, tail)
+        self.current = memoryview(b"")
+        self.offset = 0
+
+    def body(self, head, chunks, tail):
+        yield head
+        for chunk in chunks:
+            self.sent += len(chunk)
+            yield chunk
+        if self.sent != self.size:
+            raise IOError(f"Expected {self.size} bytes of file content, got {self.sent}")
+        yield tail
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        pieces = []
+        remaining = size
+        while remaining != 0:
+            if self.offset == len(self.current):
+                part = next(self.parts, None)
+                if part is None:
+                    break
+                self.current = memoryview(part)
+                self.offset = 0
+            end = len(self.current) if remaining < 0 else min(len(self.current), self.offset + remaining)
+            pieces.append(self.current[self.offset:end])
+            if remaining > 0:
+                remaining -= end - self.offset
+            self.offset = end
+        return b"".join(pieces)
+
+
+def upload(client, filename, chunks, size, path=None, select=False, start=False):
+    """Stream a file into an Octoprint server's local storage
+
+    Parameters
+    ----------
+    client: octorest.OctoRest
+        Client for the Octoprint server, whose session and timeouts are used for the upload
+    filename: str
+        Name to store the file as
+    chunks: iterable
+        Chunks of bytes making up the file
+    size: int
+        Total size of the file in bytes
+    path: str
+        Folder to put the file in, root if None
+    select: bool
+        Select the file once uploaded
+    start: bool
+        Start printing the file once uploaded
+
+    Returns
+    -------
+    dict
+        Octoprint's upload response
+
+    Raises
+    ------
+    RuntimeError
+        If Octoprint doesn't accept the upload
+    """
+    fields = {'select': str(select).lower(), 'print': str(start).lower()}
+    if path is not None:
+        fields['path'] = path
+    body = MultipartUpload(filename, chunks, size, fields)
+    with upload_seconds.time():
+        response = client.session.post(f"{client.url}/api/files/local", data=body,
+                                       headers={'Content-Type': body.content_type})
+    upload_bytes.inc(body.sent)
+    if response.status_code != 201:
+        raise RuntimeError(f"Upload of {filename} failed with status {response.status_code}: {response.text}")
+    return response.json()
@@ -0,0 +1,175 @@
+import base64
+import logging
+import smtplib
+import threading
+import time
+
+try:
+    import Metrics
+except ImportError:
+    from app import Metrics
+
+emails_sent = Metrics.Counter("emails_sent_total", "Notification emails handed to the mail transport, by outcome")
+send_seconds = Metrics.Histogram("email_batch_seconds", "Time taken to send each batch of notification emails")
+
+
+class RateLimiter:
+    """Token bucket allowing short bursts up to its capacity, refilled at a steady rate"""
+
+    def __init__(self, rate, capacity):
+        """
+        Args:
+            rate: float
+                Tokens added per second
+            capacity: int
+                Most tokens which can be saved up
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def acquire(self, count):
+        """Wait until count tokens are available, then take them"""
+        count = min(count, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return
+            time.sleep((count - self.tokens) / self.rate)
+
+
+class GmailTransport:
+    """Sends emails through the Gmail API, as many as will fit in one batch request"""
+
+    def __init__(self, mail_service):
+        self.mail_service = mail_service
+
+    def send(self, messages):
+        """
+        Parameters
+        ----------
+        messages: dict
+            Outbox ID: email.mime.text.MIMEText
+
+        Returns
+        -------
+        dict
+            Outbox ID: error message, or None if the email was sent
+        """
+        results = {}
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = str(exception) if exception is not None else None
+
+        batch = self.mail_service.new_batch_http_request(callback=callback)
+        for outbox_id, message in messages.items():
+            body = {'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+            batch.add(self.mail_service.users().messages().send(userId="me", body=body), request_id=str(outbox_id))
+        batch.execute()
+        return {outbox_id: results.get(outbox_id, "No response in batch") for outbox_id in messages}
+
+
+class SmtpTransport:
+    """Sends emails over one SMTP connection per batch, e.g. to a local debugging server while testing:
+
+        python -m smtpd -n -c DebuggingServer localhost:1025
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def send(self, messages):
+        """As for GmailTransport.send"""
+        results = {}
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            for outbox_id, message in messages.items():
+                try:
+                    smtp.send_message(message)
+                    results[outbox_id] = None
+                except smtplib.SMTPException as e:
+                    results[outbox_id] = str(e)
+        return results
+
+
+class MailWorker(threading.Thread):
+    """Background thread sending the notification emails waiting in the outbox
+
+    Emails are queued in the database alongside the job state change they're about, so nothing waits on delivery and
+    an email isn't lost if sending fails or the supervisor restarts before it goes out.
+    """
+
+    def __init__(self, queue, config):
+        """
+        Args:
+            queue: QueueInterface
+                Interface used only by this thread, as the Gmail client isn't thread-safe
+            config: dict
+                Email section of config.yml
+        """
+        super().__init__(name="Mailer", daemon=True)
+        self.queue = queue
+        self.config = config
+        if config['transport'] == "smtp":
+            self.transport = SmtpTransport(config['smtp_host'], config['smtp_port'])
+        else:
+            self.transport = GmailTransport(queue.mail_service)
+        self.limiter = RateLimiter(config['rate_limit'] / 60, config['batch_size'])
+        self.wake = threading.Event()
+
+    def retry_delay(self, attempts):
+        """Seconds to wait before trying an email again after it has failed a number of times, or None to give up"""
+        if attempts >= self.config['max_attempts']:
+            return None
+        return min(self.config['retry_delay'] * 2 ** (attempts - 1), self.config['max_retry_delay'])
+
+    def send_batch(self):
+        """Send the next batch of due emails
+
+        Returns
+        -------
+        int
+            Number of emails tried
+        """
+        due = self.queue.get_due_emails(self.config['batch_size'])
+        if not due:
+            return 0
+        self.limiter.acquire(len(due))
+        messages = {}
+        attempts = {}
+        for outbox_id, print_id, template, tries, to, filename in due:
+            messages[outbox_id] = self.queue.render_email(template, print_id, to, filename)
+            attempts[outbox_id] = tries + 1
+        try:
+            with send_seconds.time():
+                results = self.transport.send(messages)
+        except Exception as e:
+            results = dict.fromkeys(messages, str(e))
+        sent = [outbox_id for outbox_id, error in results.items() if error is None]
+        failed = {outbox_id: (self.retry_delay(attempts[outbox_id]), error)
+                  for outbox_id, error in results.items() if error is not None}
+        for outbox_id, (delay, error) in failed.items():
+            if delay is None:
+                logging.error(f"Giving up on email #{outbox_id} after {attempts[outbox_id]} attempts: {error}")
+            else:
+                logging.warning(f"Sending email #{outbox_id} failed, retrying in {delay}s: {error}")
+        emails_sent.inc(len(sent), outcome="sent")
+        emails_sent.inc(len(failed), outcome="failed")
+        self.queue.record_email_results(sent, failed)
+        return len(due)
+
+    def run(self):
+        while True:
+            try:
+                tried = self.send_batch()
+            except Exception as e:
+                logging.warning(f"Sending queued emails failed: {e}")
+                tried = 0
+            # Carry straight on while there's a backlog, otherwise wait for new emails or retries to fall due
+            if tried < self.config['batch_size']:
+                self.wake.wait(self.config['interval'])
+                self.wake.clear()
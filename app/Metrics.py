@@ -0,0 +1,216 @@
+import http.server
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the buckets durations are counted in, from a fast SQL query up to a large upload
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Registry:
+    """Collection of every metric in the process, rendered together in Prometheus' text format"""
+
+    def __init__(self):
+        # Put in front of every metric name, so metrics from different processes can be told apart once combined
+        self.prefix = ""
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        """
+        Returns
+        -------
+        bytes
+            Every metric in Prometheus' text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            name = f"{self.prefix}_{metric.name}" if self.prefix else metric.name
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.TYPE}")
+            lines.extend(metric.samples(name))
+        return ("\n".join(lines) + "\n").encode()
+
+
+registry = Registry()
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, registry=registry):
+        """
+        Args:
+            name: String
+                Metric name, without the registry's prefix
+            documentation: String
+                Description shown alongside the metric
+            registry: Registry
+                Registry to include the metric in
+        """
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}  # Sorted tuple of label (name, value) pairs: value
+        registry.register(self)
+
+    def samples(self, name):
+        with self.lock:
+            values = dict(self.values)
+        return [f"{name}{format_labels(labels)} {format_value(value)}" for labels, value in sorted(values.items())]
+
+
+class Counter(Metric):
+    """Total which only ever goes up, e.g. the number of prints started"""
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value which can go up and down, e.g. the number of idle printers"""
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. how long requests take, counted in fixed buckets"""
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS, registry=registry):
+        super().__init__(name, documentation, registry)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block takes, whether or not it raises"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self, name):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        lines = []
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', format_value(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """Serve this process' metrics on localhost in a background thread, e.g. for the web server to pass on"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    return server
+
+
+class RateLimitFilter(logging.Filter):
+    """Log filter letting through at most a set number of records from each logging call in each interval
+
+    Records from the same line of code, e.g. every printer's status on every poll, are dropped once over the limit,
+    and the next one let through says how many were dropped. Errors are never dropped.
+    """
+
+    def __init__(self, limit, interval):
+        """
+        Args:
+            limit: int
+                Records let through from each logging call per interval
+            interval: float
+                Length of each interval in seconds
+        """
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}  # (path, line): [interval start, records let through, records dropped]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault((record.pathname, record.lineno), [now, 0, 0])
+            if now - window[0] >= self.interval:
+                dropped = window[2]
+                window[:] = [now, 0, 0]
+                if dropped:
+                    record.msg = f"{record.getMessage()} ({dropped} similar messages suppressed)"
+                    record.args = ()
+            if window[1] >= self.limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+def limit_logging(config):
+    """Rate limit everything written to the log, as set up in the metrics section of config.yml
+
+    The filter goes on the handlers rather than the root logger so it also catches records from libraries' loggers.
+    """
+    log_filter = RateLimitFilter(config['log_limit'], config['log_interval'])
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(log_filter)
@@ -1,6 +1,14 @@
 import base64
-import io
+import hashlib
 import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
 from email.mime.text import MIMEText
 
 logging.basicConfig(filename='QueueInterface.log', level=logging.DEBUG,
@@ -9,76 +17,511 @@ logging.basicConfig(filename='QueueInterface.log', level=logging.DEBUG,
 import mysql.connector as mariadb
 import yaml
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.discovery_cache.base import Cache
 from oauth2client.service_account import ServiceAccountCredentials
 from requests.exceptions import ConnectionError
 
+try:
+    import Analytics
+    import GcodeCache
+    import GcodeStream
+    import Metrics
+except ImportError:
+    from app import Analytics
+    from app import GcodeCache
+    from app import GcodeStream
+    from app import Metrics
+
 with open('config.yml') as yaml_config:
     config = yaml.safe_load(yaml_config)
-    logging.debug(config)
+
+sql_seconds = Metrics.Histogram("sql_seconds", "Time taken by each SQL statement, by statement type")
+next_print_seconds = Metrics.Histogram("next_print_seconds", "Time taken to find or claim the next print, by method")
+download_seconds = Metrics.Histogram("download_seconds", "Time taken to fetch a print's gcode into a local file")
+
+
+class PooledConnection:
+    """Database connection which keeps a prepared statement for each distinct query run through it, up to a limit
+
+    Runs in autocommit mode so every statement sees the latest state of the queue without needing a commit to refresh
+    its snapshot - use transaction() to group statements which must apply together.
+    """
+
+    # Prepared statements kept open, closing the least recently used beyond this. Queries with IN-lists are a
+    # different statement for each length of list, so would otherwise use up the server's max_prepared_stmt_count
+    MAX_STATEMENTS = 64
+
+    def __init__(self, **connect_args):
+        self.connect_args = connect_args
+        self.database = None
+        self.statements = OrderedDict()  # Query: prepared cursor, least recently used first
+        self.in_transaction = False
+        self.connect()
+
+    def connect(self):
+        """(Re)open the connection, discarding prepared statements belonging to any previous session"""
+        if self.database is not None:
+            try:
+                self.database.close()
+            except mariadb.Error:
+                pass
+        self.statements = OrderedDict()
+        self.database = mariadb.connect(autocommit=True, **self.connect_args)
+
+    def _prepare(self, query):
+        cursor = self.statements.get(query)
+        if cursor is not None:
+            self.statements.move_to_end(query)
+            return cursor
+        if len(self.statements) >= self.MAX_STATEMENTS:
+            _, evicted = self.statements.popitem(last=False)
+            try:
+                # Deallocates the statement on the server
+                evicted.close()
+            except mariadb.Error:
+                pass
+        cursor = self.database.cursor(prepared=True)
+        self.statements[query] = cursor
+        return cursor
+
+    def _execute(self, query, params):
+        """Run a statement, reconnecting and retrying once if the server has dropped the connection"""
+        try:
+            cursor = self._prepare(query)
+            with sql_seconds.time(statement=query.split(None, 1)[0].upper()):
+                cursor.execute(query, params)
+        except (mariadb.OperationalError, mariadb.InterfaceError) as e:
+            if self.in_transaction:
+                # Earlier statements in the transaction were lost with the connection, so it can't just be replayed
+                raise
+            logging.warning(f"Database connection lost ({e}), reconnecting")
+            self.connect()
+            cursor = self._prepare(query)
+            cursor.execute(query, params)
+        return cursor
+
+    def execute(self, query, params=()):
+        """Run a parameterised statement
+
+        Parameters
+        ----------
+        query: str
+            SQL statement using ? placeholders
+        params: tuple
+            Values for the placeholders
+
+        Returns
+        -------
+        int
+            Number of rows affected
+        """
+        cursor = self._execute(query, params)
+        if cursor.with_rows:
+            cursor.fetchall()
+        return cursor.rowcount
+
+    def fetchall(self, query, params=()):
+        """Run a parameterised query, returning every row as a tuple"""
+        cursor = self._execute(query, params)
+        # The binary protocol can return text columns undecoded
+        return [tuple(value.decode() if isinstance(value, (bytes, bytearray)) else value for value in row)
+                for row in cursor.fetchall()]
+
+    def fetchone(self, query, params=()):
+        """Run a parameterised query, returning the first row or None"""
+        rows = self.fetchall(query, params)
+        return rows[0] if rows else None
+
+    @contextmanager
+    def transaction(self):
+        """Apply all statements within the with block together, or none of them if it raises"""
+        try:
+            self.database.start_transaction()
+        except (mariadb.OperationalError, mariadb.InterfaceError) as e:
+            logging.warning(f"Database connection lost ({e}), reconnecting")
+            self.connect()
+            self.database.start_transaction()
+        self.in_transaction = True
+        try:
+            yield self
+            self.database.commit()
+        except Exception:
+            try:
+                self.database.rollback()
+            except mariadb.Error:
+                pass
+            raise
+        finally:
+            self.in_transaction = False
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections shared by every QueueInterface in the process
+
+    Connections are only opened when first needed, up to the pool size, and callers block while all are in use.
+    """
+
+    def __init__(self, size, connection_class=PooledConnection, **connect_args):
+        """
+        Args:
+            size: int
+                Maximum number of connections open at once
+            connection_class: type
+                Opens a connection when called with connect_args, e.g. another database for benchmarking
+        """
+        self.connection_class = connection_class
+        self.connect_args = connect_args
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block"""
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except Empty:
+                connection = self.connection_class(**self.connect_args)
+            try:
+                yield connection
+            finally:
+                self.idle.put(connection)
+
+
+pool = ConnectionPool(
+    config['queue']['pool_size'],
+    host=config['queue']['server']['host'],
+    user=config['queue']['server']['user'],
+    passwd=config['queue']['server']['password'],
+    database=config['queue']['server']['database']
+)
+
+cache = None
+cache_lock = threading.Lock()
+
+
+def get_cache():
+    """The gcode cache shared by every QueueInterface in the process
+
+    Created on first use, as it reads through the whole cache folder, which processes only reading the queue never need.
+    """
+    global cache
+    with cache_lock:
+        if cache is None:
+            cache = GcodeCache.GcodeCache(config['cache']['directory'], config['cache']['max_size'] * 1024 * 1024)
+        return cache
+
+
+class DiscoveryCache(Cache):
+    """Google API discovery documents kept in memory and on disk, so building a client doesn't fetch and parse the
+    document from Google every time, including after a restart
+
+    Documents older than max_age are fetched again, in case the API has changed.
+    """
+
+    def __init__(self, directory, max_age):
+        """
+        Args:
+            directory: String
+                Folder to keep documents in, created if missing
+            max_age: float
+                Seconds a document is used for before being fetched again
+        """
+        self.directory = directory
+        self.max_age = max_age
+        self.documents = {}  # URL: (time fetched, document)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get(self, url):
+        with self.lock:
+            if url in self.documents and time.time() - self.documents[url][0] < self.max_age:
+                return self.documents[url][1]
+        try:
+            fetched = os.path.getmtime(self.path(url))
+            if time.time() - fetched >= self.max_age:
+                return None
+            with open(self.path(url)) as document_file:
+                document = document_file.read()
+        except OSError:
+            return None
+        with self.lock:
+            self.documents[url] = (fetched, document)
+        return document
+
+    def set(self, url, content):
+        with self.lock:
+            self.documents[url] = (time.time(), content)
+        try:
+            with open(self.path(url) + ".tmp", 'w') as document_file:
+                document_file.write(content)
+            os.replace(self.path(url) + ".tmp", self.path(url))
+        except OSError as e:
+            logging.warning(f"Couldn't save discovery document for {url}: {e}")
+
+
+discovery_cache = DiscoveryCache(config['cache']['discovery_directory'], config['cache']['discovery_max_age'])
+
+
+class UnitOfWork:
+    """Print state changes gathered over one supervisor tick, so QueueInterface.commit_work can write them together
+
+    Changes can be recorded from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}  # Print ID: printer ID
+        self.complete = {}  # Print ID: (printer ID, print time, filament used)
+        self.failed = {}  # Print ID: printer ID
+        self.queued = set()  # IDs of prints to return to the queue
+
+    def mark_running(self, print_id, printer_id):
+        with self.lock:
+            self.running[print_id] = printer_id
+
+    def mark_complete(self, print_id, printer_id, print_time, filament_used):
+        with self.lock:
+            self.complete[print_id] = (printer_id, print_time, filament_used)
+
+    def mark_failed(self, print_id, printer_id):
+        with self.lock:
+            self.failed[print_id] = printer_id
+
+    def mark_queued(self, print_id):
+        """Return a claimed or running print to the queue, e.g. when it never started"""
+        with self.lock:
+            self.queued.add(print_id)
+
+    def take(self):
+        """Remove and return everything recorded so far
+
+        Returns
+        -------
+        tuple
+            (running, complete, failed) dicts and the queued set
+        """
+        with self.lock:
+            changes = self.running, self.complete, self.failed, self.queued
+            self.running, self.complete, self.failed, self.queued = {}, {}, {}, set()
+        return changes
+
+    def restore(self, changes):
+        """Put back changes returned by take which couldn't be written, without overwriting anything newer"""
+        running, complete, failed, queued = changes
+        with self.lock:
+            self.running = {**running, **self.running}
+            self.complete = {**complete, **self.complete}
+            self.failed = {**failed, **self.failed}
+            self.queued = queued | self.queued
+
+
+def placeholders(count):
+    return ", ".join("?" * count)
+
+
+# Notification emails: (subject, text), formatted with print_id, filename, name and signature
+EMAIL_TEMPLATES = {
+    'complete': ("{name} 3D Print ID#{print_id} Complete", """
+Your print ID#{print_id} with filename "{filename}" has successfully completed.
+
+Please come and collect it from us as soon as possible!
+
+Best regards,
+{signature}
+"""),
+    'failed': ("{name} 3D Print ID#{print_id} Failed", """
+Your print ID#{print_id} with filename "{filename}" has failed.
+
+Please come and talk to us so we can sort things out.
+
+Best regards,
+{signature}
+""")
+}
 
 
 class QueueInterface:
     """Interface for the MariaDB print database"""
 
+    # Only succeeds while the print is still queued, so a print can't be claimed twice
+    CLAIM_QUERY = (
+        "UPDATE `prints` "
+        "SET `print status` = 'Claimed', `assigned printer` = ? "
+        "WHERE `id` = ? AND `print status` = 'Queued'"
+    )
+    # Added to a claim when supervisors share the farm, so it only succeeds while the claiming supervisor still holds
+    # the printer's lease - a supervisor which has lost a printer to another can't start a print on it too
+    LEASE_CONDITION = (
+        " AND {printer} IN (SELECT `id` FROM `printers` WHERE `supervisor` = ? AND `lease expires` > CURRENT_TIMESTAMP)"
+    )
+
     def __init__(self):
-        # Initialise the database and Google Drive connection
+        # Google clients are only built when first used, as many interfaces never touch Drive or Gmail at all, e.g. the
+        # web server's. Database connections are shared through the pool
         self.scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/gmail.send']
-        self.credentials = ServiceAccountCredentials.from_json_keyfile_name('serviceaccount.json', self.scope)
-        self.service = build('drive', 'v3', credentials=self.credentials)
-        self.mail_service = build('gmail', 'v1', credentials=self.credentials)
+        self.credentials = None
+        self._service = None
+        self._mail_service = None
+        self._cache = None
+        self.client_lock = threading.Lock()
 
-        self.database = mariadb.connect(
-            host=config['queue']['server']['host'],
-            user=config['queue']['server']['user'],
-            passwd=config['queue']['server']['password'],
-            database=config['queue']['server']['database']
-        )
+        self.pool = pool
 
-    def __del__(self):
-        # Close the database connection on close
-        self.database.close()
+    def build_client(self, name, version):
+        with self.client_lock:
+            if self.credentials is None:
+                self.credentials = ServiceAccountCredentials.from_json_keyfile_name('serviceaccount.json', self.scope)
+            return build(name, version, credentials=self.credentials, cache=discovery_cache)
 
-    def create_email_message(self, to, subject, text):
+    @property
+    def service(self):
+        """Google Drive client"""
+        if self._service is None:
+            self._service = self.build_client('drive', 'v3')
+        return self._service
+
+    @service.setter
+    def service(self, service):
+        self._service = service
+
+    @property
+    def mail_service(self):
+        """Gmail client"""
+        if self._mail_service is None:
+            self._mail_service = self.build_client('gmail', 'v1')
+        return self._mail_service
+
+    @mail_service.setter
+    def mail_service(self, mail_service):
+        self._mail_service = mail_service
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache()
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache):
+        self._cache = cache
+
+    def build_email(self, to, subject, text):
         message = MIMEText(text)
         message['to'] = to
         message['from'] = config['email']['address']
         message['subject'] = subject
-        return {'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+        return message
+
+    def create_email_message(self, to, subject, text):
+        return {'raw': base64.urlsafe_b64encode(self.build_email(to, subject, text).as_bytes()).decode()}
 
     def send_email(self, message):
         message_id = self.mail_service.users().messages().send(userId="me", body=message).execute()
         logging.debug(f"Email sent: {message_id}")
 
-    def send_complete_email(self, print_id):
-        details = self.get_details(print_id)
-        subject = f"{config['email']['name']} 3D Print ID#{print_id} Complete"
-        text = f"""
-Your print ID#{print_id} with filename "{details[3]}" has successfully completed.
+    def render_email(self, template, print_id, to, filename):
+        """Build one of the notification emails in EMAIL_TEMPLATES
 
-Please come and collect it from us as soon as possible!
+        Returns
+        -------
+        email.mime.text.MIMEText
+        """
+        subject, text = EMAIL_TEMPLATES[template]
+        values = {'print_id': print_id, 'filename': filename, 'name': config['email']['name'],
+                  'signature': config['email']['signature']}
+        return self.build_email(to, subject.format(**values), text.format(**values))
 
-Best regards,
-{config['email']['signature']}
-"""
-        to = details[1]
-        message = self.create_email_message(to, subject, text)
-        self.send_email(message)
+    def queue_email(self, print_id, template):
+        """Add a notification email about a print to the outbox, for the mail worker to send in the background"""
+        logging.debug(f"Queueing {template} email for ID {print_id}")
+        query = (
+            "INSERT INTO `email outbox` (`print id`, `template`) "
+            "VALUES (?, ?)"
+        )
+        with self.pool.connection() as connection:
+            connection.execute(query, (print_id, template))
+
+    def send_complete_email(self, print_id):
+        self.queue_email(print_id, 'complete')
 
     def send_failed_email(self, print_id):
-        details = self.get_details(print_id)
-        subject = f"{config['email']['name']} 3D Print ID#{print_id} Failed"
-        text = f"""
-Your print ID#{print_id} with filename "{details[3]}" has failed.
+        self.queue_email(print_id, 'failed')
 
-Please come and talk to us so we can sort things out.
+    def get_due_emails(self, limit):
+        """Claim the emails in the outbox which are due to be sent or retried, oldest due first
 
-Best regards,
-{config['email']['signature']}
-"""
-        to = details[1]
-        message = self.create_email_message(to, subject, text)
-        self.send_email(message)
+        Claimed emails aren't due again until the retry delay has passed, so supervisors sharing the farm don't send
+        the same email twice, and an email claimed by a supervisor which then stopped is still sent.
+
+        Parameters
+        ----------
+        limit: int
+            Maximum number of emails to claim
+
+        Returns
+        -------
+        list
+            (outbox id, print id, template, attempts, email address, gcode filename) of each email
+        """
+        claim = uuid.uuid4().hex
+        claim_query = (
+            "UPDATE `email outbox` "
+            "SET `claimed by` = ?, `next attempt` = CURRENT_TIMESTAMP + INTERVAL ? SECOND "
+            "WHERE `status` = 'Pending' AND `next attempt` <= CURRENT_TIMESTAMP "
+            "ORDER BY `next attempt` ASC "
+            "LIMIT ?"
+        )
+        query = (
+            "SELECT `email outbox`.`id`, `print id`, `template`, `attempts`, `email address`, `gcode filename` "
+            "FROM `email outbox` "
+            "JOIN `prints` ON `prints`.`id` = `email outbox`.`print id` "
+            "WHERE `claimed by` = ? AND `status` = 'Pending' "
+            "ORDER BY `email outbox`.`id` ASC"
+        )
+        with self.pool.connection() as connection:
+            if not connection.execute(claim_query, (claim, config['email']['retry_delay'], limit)):
+                return []
+            return connection.fetchall(query, (claim,))
+
+    def record_email_results(self, sent, failed):
+        """Mark emails as sent, or schedule them to be retried, in one transaction
+
+        Parameters
+        ----------
+        sent: list
+            Outbox IDs of emails which were sent
+        failed: dict
+            Outbox ID: (seconds until the next attempt, or None to give up, error message) of emails which weren't
+        """
+        sent_query = (
+            "UPDATE `email outbox` "
+            "SET `status` = 'Sent', `sent` = CURRENT_TIMESTAMP, `attempts` = `attempts` + 1 "
+            f"WHERE `id` IN ({placeholders(len(sent))})"
+        )
+        retry_query = (
+            "UPDATE `email outbox` "
+            "SET `attempts` = `attempts` + 1, `next attempt` = CURRENT_TIMESTAMP + INTERVAL ? SECOND, "
+            "`last error` = ? "
+            "WHERE `id` = ?"
+        )
+        give_up_query = (
+            "UPDATE `email outbox` "
+            "SET `status` = 'Failed', `attempts` = `attempts` + 1, `last error` = ? "
+            "WHERE `id` = ?"
+        )
+        with self.pool.connection() as connection:
+            with connection.transaction():
+                if sent:
+                    connection.execute(sent_query, list(sent))
+                for outbox_id, (delay, error) in failed.items():
+                    if delay is None:
+                        connection.execute(give_up_query, (error, outbox_id))
+                    else:
+                        connection.execute(retry_query, (delay, error, outbox_id))
 
     def get_valid_printers(self):
         """Retrieve a list of valid printer types
@@ -88,17 +531,12 @@ Best regards,
         set
             Set of valid printer types from database
         """
-        self.database.commit()
-        printer_types = set()
-        cursor = self.database.cursor()
         query = (
             "SELECT `type` "
             "FROM `printers`"
         )
-        cursor.execute(query)
-        for printer_type in cursor:
-            printer_types.add(printer_type[0])
-        cursor.close()
+        with self.pool.connection() as connection:
+            printer_types = set(printer_type[0] for printer_type in connection.fetchall(query))
         logging.debug(f"Printer types: {printer_types}")
         return printer_types
 
@@ -115,30 +553,24 @@ Best regards,
         dict
             Follows structure of database
         """
-        self.database.commit()
-        cursor = self.database.cursor()
         query = (
             "SELECT * "
             "FROM `prints` "
-            f"WHERE `id` = {print_id}"
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        result = cursor.fetchone()
-        cursor.close()
+        with self.pool.connection() as connection:
+            result = connection.fetchone(query, (print_id,))
         logging.debug(result)
         return result
 
     def get_status(self, print_id):
-        self.database.commit()
-        cursor = self.database.cursor()
         query = (
             "SELECT `print status` "
             "FROM `prints` "
-            f"WHERE `id` = {print_id}"
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        result = cursor.fetchone()
-        cursor.close()
+        with self.pool.connection() as connection:
+            result = connection.fetchone(query, (print_id,))
         logging.debug(result)
         if result is not None:
             return result[0]
@@ -146,106 +578,350 @@ Best regards,
             return None
 
     def update_status(self, print_id, new_status):
-        self.database.commit()
         logging.debug(f"Updating ID {print_id} status to {new_status}")
-        cursor = self.database.cursor()
         query = (
             "UPDATE `prints` "
-            f"SET `print status` = '{new_status}' "
-            f"WHERE `id` = {print_id}"
+            "SET `print status` = ? "
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        self.database.commit()
-        cursor.close()
+        with self.pool.connection() as connection:
+            connection.execute(query, (new_status, print_id))
 
     def mark_running(self, print_id, printer_id):
-        self.database.commit()
-
         logging.debug(f"Updating ID {print_id} start time")
-        cursor = self.database.cursor()
         query = (
             "UPDATE `prints` "
-            f"SET `start time` = CURRENT_TIMESTAMP, `assigned printer` = {printer_id}, `print status` = 'Running' "
-            f"WHERE `id` = {print_id}"
+            "SET `start time` = CURRENT_TIMESTAMP, `assigned printer` = ?, `print status` = 'Running' "
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        self.database.commit()
-
-        cursor.close()
+        with self.pool.connection() as connection:
+            connection.execute(query, (printer_id, print_id))
 
     def mark_failed(self, print_id):
-        self.database.commit()
-
         logging.debug(f"Updating ID {print_id} finish time")
-        cursor = self.database.cursor()
         query = (
             "UPDATE `prints` "
-            f"SET `finish time` = CURRENT_TIMESTAMP, `print status` = 'Failed' "
-            f"WHERE `id` = {print_id}"
+            "SET `finish time` = CURRENT_TIMESTAMP, `print status` = 'Failed' "
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        self.database.commit()
-
-        cursor.close()
+        printer_query = (
+            "UPDATE `printers` "
+            "SET `failed prints` = `failed prints` + 1 "
+            "WHERE `id` = (SELECT `assigned printer` FROM `prints` WHERE `id` = ?)"
+        )
+        with self.pool.connection() as connection:
+            with connection.transaction():
+                connection.execute(query, (print_id,))
+                connection.execute(printer_query, (print_id,))
 
     def mark_complete(self, print_id, printer_id, print_time, filament_used):
-        self.database.commit()
-
         logging.debug(f"Updating ID {print_id} finish time")
-        cursor = self.database.cursor()
-        query = (
-            f"UPDATE `prints` "
-            f"SET `finish time` = CURRENT_TIMESTAMP, `print status` = 'Complete' "
-            f"WHERE `id` = {print_id}"
+        print_query = (
+            "UPDATE `prints` "
+            "SET `finish time` = CURRENT_TIMESTAMP, `print status` = 'Complete' "
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        self.database.commit()
-
-        query = (
-            f"UPDATE `printers` "
-            f"SET `total time printed` = `total time printed` + {print_time}, "
-            f"`completed prints` = `completed prints` + 1, "
-            f"`total filament used` = `total filament used` + {filament_used} "
-            f"WHERE `id` = {printer_id}"
+        printer_query = (
+            "UPDATE `printers` "
+            "SET `total time printed` = `total time printed` + ?, "
+            "`completed prints` = `completed prints` + 1, "
+            "`total filament used` = `total filament used` + ? "
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        self.database.commit()
-
-        cursor.close()
+        with self.pool.connection() as connection:
+            with connection.transaction():
+                connection.execute(print_query, (print_id,))
+                connection.execute(printer_query, (print_time, filament_used, printer_id))
 
     def get_next_print(self, printer_type):
-        self.database.commit()
-        cursor = self.database.cursor()
         query = (
             "SELECT `id` "
             "FROM `prints` "
             "WHERE `print status` = 'Queued' "
-            f"AND `printer type` = '{printer_type}' "
+            "AND `printer type` = ? "
             "ORDER BY `added` ASC "
             "LIMIT 1"
         )
-        cursor.execute(query)
-        result = cursor.fetchone()
+        with next_print_seconds.time(method="get_next_print"), self.pool.connection() as connection:
+            result = connection.fetchone(query, (printer_type,))
         logging.debug(result)
         if result is not None:
-            print_id = result[0]
-            cursor.close()
-            return print_id
+            return result[0]
         else:
-            cursor.close()
             return 0
-        # TODO - This method does not account for anything but which print was added first
+        # Only accounts for which print was added first - the supervisor uses Scheduler for smarter choices
+
+    def claim_next_print(self, printer_type, printer_id, owner=None):
+        """Atomically reserve the next queued print for a printer, so no other caller can start it
+
+        Each candidate is claimed with a conditional update which only succeeds while the print is still queued, so
+        if another supervisor gets there first the next candidate is tried instead.
+
+        Parameters
+        ----------
+        printer_type: str
+            Type of printer the print must be queued for
+        printer_id: int
+            ID of the printer the print is being claimed for
+        owner: str
+            Name of the supervisor which must hold the printer's lease, if supervisors share the farm
+
+        Returns
+        -------
+        tuple
+            (id, drive file id, gcode filename) of the claimed print, or None if nothing is queued
+        """
+        candidate_query = (
+            "SELECT `id`, `drive file id`, `gcode filename` "
+            "FROM `prints` "
+            "WHERE `print status` = 'Queued' "
+            "AND `printer type` = ? "
+            "ORDER BY `added` ASC "
+            "LIMIT ?"
+        )
+        claim_query = self.CLAIM_QUERY
+        lease_params = ()
+        if owner is not None:
+            claim_query += self.LEASE_CONDITION.format(printer="?")
+            lease_params = (printer_id, owner)
+        with next_print_seconds.time(method="claim_next_print"), self.pool.connection() as connection:
+            for candidate in connection.fetchall(candidate_query, (printer_type, config['queue']['claim_candidates'])):
+                if connection.execute(claim_query, (printer_id, candidate[0]) + lease_params) == 1:
+                    logging.debug(f"Claimed {candidate} for printer {printer_id}")
+                    return candidate
+        return None
+
+    def claim_prints(self, plans, owner=None):
+        """Atomically reserve several prints at once, each for its own printer
+
+        A print is only claimed while it is still queued, so any which another supervisor got to first are left out.
+
+        Parameters
+        ----------
+        plans: dict
+            Printer ID: ID of the print to claim for it
+        owner: str
+            Name of the supervisor which must hold each printer's lease, if supervisors share the farm
+
+        Returns
+        -------
+        dict
+            Printer ID: (id, drive file id, gcode filename) for each print successfully claimed
+        """
+        if not plans:
+            return {}
+        printer_case = f"CASE `id` {' '.join(['WHEN ? THEN ?'] * len(plans))} END"
+        claim_query = (
+            "UPDATE `prints` "
+            f"SET `print status` = 'Claimed', `assigned printer` = {printer_case} "
+            f"WHERE `id` IN ({placeholders(len(plans))}) AND `print status` = 'Queued'"
+        )
+        claimed_query = (
+            "SELECT `id`, `drive file id`, `gcode filename`, `assigned printer` "
+            "FROM `prints` "
+            f"WHERE `id` IN ({placeholders(len(plans))}) AND `print status` = 'Claimed'"
+        )
+        print_ids = list(plans.values())
+        case_params = [value for printer_id, print_id in plans.items() for value in (print_id, printer_id)]
+        claim_params = case_params + print_ids
+        if owner is not None:
+            claim_query += self.LEASE_CONDITION.format(printer=printer_case)
+            claim_params += case_params + [owner]
+        with next_print_seconds.time(method="claim_prints"), self.pool.connection() as connection:
+            connection.execute(claim_query, claim_params)
+            rows = connection.fetchall(claimed_query, print_ids)
+        # Prints claimed earlier by someone else are still 'Claimed', but for a different printer
+        claimed = {row[3]: row[:3] for row in rows if plans.get(row[3]) == row[0]}
+        logging.debug(f"Claimed {claimed}")
+        return claimed
+
+    def commit_work(self, work):
+        """Write everything recorded in a unit of work in one transaction, with a fixed number of statements
+
+        If the database can't be reached the changes are kept in the unit of work, to be retried next time.
+
+        Parameters
+        ----------
+        work: UnitOfWork
+
+        Returns
+        -------
+        bool
+            True if the changes were written
+        """
+        changes = work.take()
+        running, complete, failed, queued = changes
+        if not any(changes):
+            return True
+        logging.debug(f"Committing running {running}, complete {complete}, failed {failed}, queued {queued}")
+        statements = []
+        if running:
+            statements.append((
+                "UPDATE `prints` "
+                "SET `start time` = CURRENT_TIMESTAMP, `print status` = 'Running', "
+                f"`assigned printer` = CASE `id` {' '.join(['WHEN ? THEN ?'] * len(running))} END "
+                f"WHERE `id` IN ({placeholders(len(running))})",
+                [value for item in running.items() for value in item] + list(running)
+            ))
+        for status, prints in (('Complete', complete), ('Failed', failed)):
+            if prints:
+                statements.append((
+                    "UPDATE `prints` "
+                    f"SET `finish time` = CURRENT_TIMESTAMP, `print status` = '{status}' "
+                    f"WHERE `id` IN ({placeholders(len(prints))})",
+                    list(prints)
+                ))
+        if queued:
+            statements.append((
+                "UPDATE `prints` "
+                "SET `print status` = 'Queued', `assigned printer` = NULL, `start time` = NULL "
+                f"WHERE `id` IN ({placeholders(len(queued))}) AND `print status` IN ('Claimed', 'Running')",
+                list(queued)
+            ))
+        # Printer counters, summed per printer in case one printer finished more than one print
+        totals = {}
+        for printer_id, print_time, filament_used in complete.values():
+            total = totals.setdefault(printer_id, [0, 0, 0, 0])
+            total[0] += print_time
+            total[1] += 1
+            total[2] += filament_used
+        for printer_id in failed.values():
+            totals.setdefault(printer_id, [0, 0, 0, 0])[3] += 1
+        if totals:
+            cases = ' '.join(['WHEN ? THEN ?'] * len(totals))
+            statements.append((
+                "UPDATE `printers` "
+                f"SET `total time printed` = `total time printed` + CASE `id` {cases} END, "
+                f"`completed prints` = `completed prints` + CASE `id` {cases} END, "
+                f"`total filament used` = `total filament used` + CASE `id` {cases} END, "
+                f"`failed prints` = `failed prints` + CASE `id` {cases} END "
+                f"WHERE `id` IN ({placeholders(len(totals))})",
+                [value for column in range(4) for printer_id, total in totals.items()
+                 for value in (printer_id, total[column])] + list(totals)
+            ))
+        if config['analytics']['summaries']:
+            # Kept up to date in the same transaction, so reports never need to scan the prints table
+            if running:
+                statements.append(Analytics.started_statement(list(running)))
+            if totals:
+                statements.append(Analytics.finished_statement(totals))
+        if config['email']['notifications'] and (complete or failed):
+            # Queued in the same transaction, so an email is sent exactly when the state change is saved
+            emails = [(print_id, 'complete') for print_id in complete] + [(print_id, 'failed') for print_id in failed]
+            statements.append((
+                "INSERT INTO `email outbox` (`print id`, `template`) "
+                f"VALUES {', '.join(['(?, ?)'] * len(emails))}",
+                [value for email in emails for value in email]
+            ))
+        try:
+            with self.pool.connection() as connection:
+                with connection.transaction():
+                    for query, params in statements:
+                        connection.execute(query, params)
+        except mariadb.Error as e:
+            logging.error(f"Failed to commit print state changes, will retry: {e}")
+            work.restore(changes)
+            return False
+        return True
+
+    def get_queue_snapshot(self):
+        """Retrieve every print which is queued or in progress, for the scheduler to work from in one go
+
+        Returns
+        -------
+        list
+            (id, email address, project type, printer type, filament estimate, expected duration, added, print status)
+            of each print, matching Scheduler.Job
+        """
+        query = (
+            "SELECT `id`, `email address`, `project type`, `printer type`, `filament estimate`, `expected duration`, "
+            "`added`, `print status` "
+            "FROM `prints` "
+            "WHERE `print status` IN ('Queued', 'Claimed', 'Running')"
+        )
+        with self.pool.connection() as connection:
+            result = connection.fetchall(query)
+        logging.debug(f"Queue snapshot of {len(result)} prints")
+        return result
+
+    def release_claim(self, print_id):
+        """Return a claimed print to the queue, e.g. when it couldn't be sent to its printer"""
+        logging.debug(f"Releasing claim on ID {print_id}")
+        query = (
+            "UPDATE `prints` "
+            "SET `print status` = 'Queued', `assigned printer` = NULL "
+            "WHERE `id` = ? AND `print status` = 'Claimed'"
+        )
+        with self.pool.connection() as connection:
+            connection.execute(query, (print_id,))
+
+    def get_unfinished_prints(self, printer_ids, print_ids):
+        """Retrieve the prints claimed by or running on some printers, and the status of some other prints, in one go
+
+        Parameters
+        ----------
+        printer_ids: iterable
+            Printers whose claimed and running prints are wanted
+        print_ids: iterable
+            Further prints wanted whatever their status, e.g. those found on the printers
+
+        Returns
+        -------
+        dict
+            Print ID: (print status, assigned printer)
+        """
+        printer_ids = list(printer_ids)
+        print_ids = list(print_ids)
+        if not printer_ids:
+            return {}
+        query = (
+            "SELECT `id`, `print status`, `assigned printer` "
+            "FROM `prints` "
+            "WHERE (`print status` IN ('Claimed', 'Running') "
+            f"AND `assigned printer` IN ({placeholders(len(printer_ids))}))"
+        )
+        if print_ids:
+            query += f" OR `id` IN ({placeholders(len(print_ids))})"
+        with self.pool.connection() as connection:
+            rows = connection.fetchall(query, printer_ids + print_ids)
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def release_stale_claims(self, exclude=()):
+        """Return prints to the queue which were claimed but never started, e.g. because a supervisor crashed
+
+        Parameters
+        ----------
+        exclude: iterable
+            IDs of printers whose claims are left alone, e.g. ones reconcile has just settled
+
+        Returns
+        -------
+        int
+            Number of claims released
+        """
+        exclude = list(exclude)
+        query = (
+            "UPDATE `prints` "
+            "SET `print status` = 'Queued', `assigned printer` = NULL "
+            "WHERE `print status` = 'Claimed' "
+            "AND `last updated` < CURRENT_TIMESTAMP - INTERVAL ? SECOND"
+        )
+        if exclude:
+            query += f" AND `assigned printer` NOT IN ({placeholders(len(exclude))})"
+        with self.pool.connection() as connection:
+            released = connection.execute(query, [config['queue']['claim_timeout']] + exclude)
+        if released:
+            logging.warning(f"Released {released} stale claims")
+        return released
 
     def download_file(self, print_id, filename_override=None):
-        self.database.commit()
-        cursor = self.database.cursor()
         query = (
             "SELECT `drive file id`, `gcode filename` "
             "FROM `prints` "
-            f"WHERE `id` = '{print_id}'"
+            "WHERE `id` = ?"
         )
-        cursor.execute(query)
-        result = cursor.fetchone()
+        with self.pool.connection() as connection:
+            result = connection.fetchone(query, (print_id,))
         logging.debug(result)
         if result is not None:
             file_id = result[0]
@@ -255,31 +931,266 @@ Best regards,
                 filename = result[1]
         else:
             return
-        # Get file from Google Drive
-        request = self.service.files().get_media(fileId=file_id)
-        fh = io.FileIO(filename, mode='wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            logging.debug(f"Downloading {filename}, status {status}")
+        # Get file from the local cache, which downloads it from Google Drive if needed. Copied so the caller can
+        # modify or remove it without affecting the cache
+        with download_seconds.time():
+            shutil.copyfile(self.cache.get(self.service, file_id), filename)
         return filename
 
+    def stream_file(self, print_id, file_id=None):
+        """Open a print's gcode for streaming, from the local cache if there, otherwise directly from Google Drive
+
+        Nothing is written to disk either way.
+
+        Parameters
+        ----------
+        print_id: int
+            The ID of the print
+        file_id: str
+            Drive file ID of the print if already known, e.g. from claiming it, saving a query
+
+        Returns
+        -------
+        tuple
+            (iterable of chunks of bytes, total size in bytes), or None if the print doesn't exist
+        """
+        if file_id is None:
+            query = (
+                "SELECT `drive file id` "
+                "FROM `prints` "
+                "WHERE `id` = ?"
+            )
+            with self.pool.connection() as connection:
+                result = connection.fetchone(query, (print_id,))
+            logging.debug(result)
+            if result is None:
+                return None
+            file_id = result[0]
+        metadata = self.service.files().get(fileId=file_id, fields="md5Checksum,size").execute()
+        cached = self.cache.open(file_id, metadata['md5Checksum'])
+        if cached is not None:
+            return GcodeStream.file_chunks(cached), os.fstat(cached.fileno()).st_size
+        return GcodeStream.drive_chunks(self.service, file_id), int(metadata['size'])
+
+    def get_unanalysed_prints(self, limit):
+        """Retrieve prints waiting in the queue which don't have an expected duration yet, oldest first
+
+        Parameters
+        ----------
+        limit: int
+            Maximum number of prints to return
+
+        Returns
+        -------
+        list
+            (id, drive file id) of each print
+        """
+        query = (
+            "SELECT `id`, `drive file id` "
+            "FROM `prints` "
+            "WHERE `expected duration` IS NULL "
+            "AND `print status` IN ('Pending Check', 'Queued') "
+            "ORDER BY `added` ASC "
+            "LIMIT ?"
+        )
+        with self.pool.connection() as connection:
+            return connection.fetchall(query, (limit,))
+
+    def set_estimates(self, print_id, expected_duration, filament_estimate):
+        """Record how long a print is expected to take and how much filament it needs
+
+        Parameters
+        ----------
+        print_id: int
+            The ID of the print
+        expected_duration: datetime.timedelta
+        filament_estimate: float
+            Filament needed in grams
+        """
+        logging.debug(f"Updating ID {print_id} estimates to {expected_duration}, {filament_estimate}g")
+        query = (
+            "UPDATE `prints` "
+            "SET `expected duration` = ?, `filament estimate` = ? "
+            "WHERE `id` = ?"
+        )
+        with self.pool.connection() as connection:
+            connection.execute(query, (expected_duration, filament_estimate, print_id))
+
+    def get_queued_prints(self, printer_type, limit):
+        """Look ahead at the prints next in line for a printer type, without claiming them
+
+        Parameters
+        ----------
+        printer_type: str
+            Type of printer the prints are queued for
+        limit: int
+            Maximum number of prints to return
+
+        Returns
+        -------
+        list
+            (id, drive file id, gcode filename) of each print, in queue order
+        """
+        query = (
+            "SELECT `id`, `drive file id`, `gcode filename` "
+            "FROM `prints` "
+            "WHERE `print status` = 'Queued' "
+            "AND `printer type` = ? "
+            "ORDER BY `added` ASC "
+            "LIMIT ?"
+        )
+        with self.pool.connection() as connection:
+            result = connection.fetchall(query, (printer_type, limit))
+        logging.debug(result)
+        return result
+
+    def get_queue_depths(self):
+        """Count the queued prints waiting for each printer type
+
+        Returns
+        -------
+        dict
+            Printer type: number of queued prints
+        """
+        query = (
+            "SELECT `printer type`, COUNT(*) "
+            "FROM `prints` "
+            "WHERE `print status` = 'Queued' "
+            "GROUP BY `printer type`"
+        )
+        with self.pool.connection() as connection:
+            result = connection.fetchall(query)
+        logging.debug(result)
+        return dict(result)
+
     def get_all_printer_details(self):
-        self.database.commit()
-        cursor = self.database.cursor()
         query = (
             "SELECT `id`, `name`, `type`, `ip address`, `api key` "
             "FROM printers"
         )
-        cursor.execute(query)
-        result = cursor.fetchall()
+        with self.pool.connection() as connection:
+            result = connection.fetchall(query)
         logging.debug(result)
         return result
 
+    def get_printers_checksum(self):
+        """Checksum the columns of the printers table needed to connect to each printer
+
+        Cheap enough to check often before reading the whole table again. Counters such as completed prints are left
+        out, so finishing a print doesn't count as a change.
+
+        Returns
+        -------
+        tuple
+            (number of printers, checksum)
+        """
+        query = (
+            "SELECT COUNT(*), BIT_XOR(CRC32(CONCAT_WS(',', `id`, QUOTE(`name`), QUOTE(`type`), QUOTE(`ip address`), "
+            "QUOTE(`api key`)))) "
+            "FROM printers"
+        )
+        with self.pool.connection() as connection:
+            return tuple(connection.fetchone(query))
+
+    def get_report(self, period, start, end, group):
+        """Summarise the prints started and finished in a range of days or weeks, from the materialised summaries
+
+        Parameters
+        ----------
+        period: str
+            "day" or "week"
+        start: datetime.date
+            First day of the range
+        end: datetime.date
+            Last day of the range
+        group: str
+            "printer" or "type"
+
+        Returns
+        -------
+        list
+            Throughput, failure rate, mean queue wait and utilisation for each period and printer or printer type, as
+            dicts ready to serialise as JSON
+        """
+        query, params = Analytics.report_query(period, start, end, group)
+        with self.pool.connection() as connection:
+            rows = connection.fetchall(query, params)
+        return Analytics.report_rows(rows, period, group)
+
+    def update_leases(self, node, lease_time, busy):
+        """Heartbeat a supervisor, renew its leases and rebalance printers between live supervisors in one transaction
+
+        Each supervisor aims for an even share of the printers. Printers over its share are released for the others to
+        take, except busy ones, and printers under its share are taken from those nobody holds, including any whose
+        supervisor has stopped renewing their leases.
+
+        Parameters
+        ----------
+        node: str
+            Name of the supervisor
+        lease_time: int
+            Seconds heartbeats and leases last without being renewed
+        busy: set
+            IDs of printers which mustn't be released yet, e.g. with a dispatch in progress
+
+        Returns
+        -------
+        set
+            IDs of the printers the supervisor holds
+        """
+        heartbeat_query = (
+            "INSERT INTO `supervisors` (`name`, `heartbeat`) "
+            "VALUES (?, CURRENT_TIMESTAMP) "
+            "ON DUPLICATE KEY UPDATE `heartbeat` = CURRENT_TIMESTAMP"
+        )
+        renew_query = (
+            "UPDATE `printers` "
+            "SET `lease expires` = CURRENT_TIMESTAMP + INTERVAL ? SECOND "
+            "WHERE `supervisor` = ?"
+        )
+        count_query = (
+            "SELECT "
+            "(SELECT COUNT(*) FROM `supervisors` WHERE `heartbeat` > CURRENT_TIMESTAMP - INTERVAL ? SECOND), "
+            "(SELECT COUNT(*) FROM `printers` WHERE `api key` IS NOT NULL)"
+        )
+        held_query = (
+            "SELECT `id` "
+            "FROM `printers` "
+            "WHERE `supervisor` = ? AND `api key` IS NOT NULL "
+            "ORDER BY `id` DESC"
+        )
+        acquire_query = (
+            "UPDATE `printers` "
+            "SET `supervisor` = ?, `lease expires` = CURRENT_TIMESTAMP + INTERVAL ? SECOND "
+            "WHERE `api key` IS NOT NULL AND (`supervisor` IS NULL OR `lease expires` < CURRENT_TIMESTAMP) "
+            "ORDER BY `id` "
+            "LIMIT ?"
+        )
+        with self.pool.connection() as connection:
+            with connection.transaction():
+                connection.execute(heartbeat_query, (node,))
+                connection.execute(renew_query, (lease_time, node))
+                nodes, printers = connection.fetchone(count_query, (lease_time,))
+                held = [row[0] for row in connection.fetchall(held_query, (node,))]
+                share = -(-printers // max(nodes, 1))
+                release = []
+                if len(held) > share:
+                    release = [printer_id for printer_id in held if printer_id not in busy][:len(held) - share]
+                    if release:
+                        logging.info(f"Releasing printers {release} to rebalance between {nodes} supervisors")
+                        connection.execute(
+                            "UPDATE `printers` "
+                            "SET `supervisor` = NULL, `lease expires` = NULL "
+                            f"WHERE `supervisor` = ? AND `id` IN ({placeholders(len(release))})",
+                            [node] + release
+                        )
+                elif len(held) < share and connection.execute(acquire_query, (node, lease_time, share - len(held))):
+                    held = [row[0] for row in connection.fetchall(held_query, (node,))]
+                    logging.info(f"Now holding printers {held}")
+        return set(held) - set(release)
+
 
 if __name__ == "__main__":
-    import shutil
     from tkinter import filedialog
     from tkinter import *
 
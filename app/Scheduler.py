@@ -0,0 +1,211 @@
+import datetime
+from collections import Counter, defaultdict, namedtuple
+
+# Columns of QueueInterface.get_queue_snapshot
+Job = namedtuple('Job', ['id', 'email', 'project_type', 'printer_type', 'filament_estimate', 'expected_duration',
+                         'added', 'status'])
+
+
+class Context:
+    """State shared by policies while one round of scheduling is worked out"""
+
+    def __init__(self, now, active, filament):
+        """
+        Args:
+            now: datetime.datetime
+                Time the schedule is being worked out for
+            active: Counter
+                Number of prints each email address has running, claimed or assigned so far
+            filament: Counter
+                Grams of filament those prints are expected to use, for each email address
+        """
+        self.now = now
+        self.active = active
+        self.filament = filament
+
+
+class Policy:
+    """Orders the queued prints a printer could start, lowest key first"""
+
+    def key(self, job, context):
+        raise NotImplementedError
+
+
+class FirstComeFirstServed(Policy):
+    """Prefer whichever print was added first"""
+
+    def key(self, job, context):
+        return job.added
+
+
+class ShortestJobFirst(Policy):
+    """Prefer the shortest prints, so long prints don't hold up lots of short ones
+
+    Any print which has waited longer than the fairness bound goes ahead of everything else, so long prints are still
+    guaranteed to start eventually.
+    """
+
+    def __init__(self, max_wait, default_duration):
+        """
+        Args:
+            max_wait: datetime.timedelta
+                Time after which a print is no longer held back for being long
+            default_duration: datetime.timedelta
+                Duration assumed for prints without an expected duration
+        """
+        self.max_wait = max_wait
+        self.default_duration = default_duration
+
+    def key(self, job, context):
+        if context.now - job.added > self.max_wait:
+            return 0, datetime.timedelta(0)
+        return 1, job.expected_duration or self.default_duration
+
+
+class OvernightPacking(Policy):
+    """Save long prints for the overnight window, when nobody is around to start the next print anyway
+
+    Within the window the longest prints go first. Outside it, long prints are only chosen if nothing else is queued.
+    """
+
+    def __init__(self, start, end, long_job, default_duration):
+        """
+        Args:
+            start: datetime.time
+                Start of the overnight window
+            end: datetime.time
+                End of the overnight window, which may be on the next day
+            long_job: datetime.timedelta
+                Prints expected to take at least this long count as long
+            default_duration: datetime.timedelta
+                Duration assumed for prints without an expected duration
+        """
+        self.start = start
+        self.end = end
+        self.long_job = long_job
+        self.default_duration = default_duration
+
+    def overnight(self, now):
+        if self.start <= self.end:
+            return self.start <= now.time() < self.end
+        return now.time() >= self.start or now.time() < self.end
+
+    def key(self, job, context):
+        duration = job.expected_duration or self.default_duration
+        if self.overnight(context.now):
+            return -duration
+        return duration >= self.long_job
+
+
+class FairShare(Policy):
+    """Prefer users with the fewest prints already running, so one user's batch can't take over the farm
+
+    Users with as many prints running are told apart by how much filament those prints use, so a few heavy prints
+    count for more than the same number of light ones.
+    """
+
+    def key(self, job, context):
+        return context.active[job.email], context.filament[job.email]
+
+
+class ProjectPriority(Policy):
+    """Prefer some project types over others, e.g. coursework over personal projects"""
+
+    def __init__(self, priorities, default):
+        """
+        Args:
+            priorities: dict
+                Project type: priority, lowest first
+            default: int
+                Priority of project types not listed
+        """
+        self.priorities = priorities
+        self.default = default
+
+    def key(self, job, context):
+        return self.priorities.get(job.project_type, self.default)
+
+
+class Scheduler:
+    """Matches queued prints to idle printers in memory, using a list of policies in order of importance
+
+    Each policy only breaks ties left by the ones before it, and first come first served breaks any remaining ties.
+    """
+
+    def __init__(self, policies):
+        """
+        Args:
+            policies: list
+                Policy instances, most important first
+        """
+        self.policies = policies + [FirstComeFirstServed()]
+
+    def key(self, job, context):
+        return tuple(policy.key(job, context) for policy in self.policies)
+
+    def assign(self, snapshot, printers, now=None):
+        """Choose the next print for each idle printer
+
+        Parameters
+        ----------
+        snapshot: list
+            Rows from QueueInterface.get_queue_snapshot
+        printers: dict
+            ID: type of each idle printer
+        now: datetime.datetime
+            Time to schedule for, the current time if None
+
+        Returns
+        -------
+        dict
+            Printer ID: Job to start on it, for each printer with a compatible print queued
+        """
+        jobs = [Job._make(row) for row in snapshot]
+        filament = Counter()
+        for job in jobs:
+            if job.status != 'Queued':
+                filament[job.email] += job.filament_estimate or 0
+        context = Context(now or datetime.datetime.now(), Counter(job.email for job in jobs if job.status != 'Queued'),
+                          filament)
+        queued = defaultdict(list)
+        for job in jobs:
+            if job.status == 'Queued':
+                queued[job.printer_type].append(job)
+
+        assignments = {}
+        for printer_id, printer_type in printers.items():
+            if not queued[printer_type]:
+                continue
+            job = min(queued[printer_type], key=lambda job: self.key(job, context))
+            queued[printer_type].remove(job)
+            context.active[job.email] += 1
+            context.filament[job.email] += job.filament_estimate or 0
+            assignments[printer_id] = job
+        return assignments
+
+
+def from_config(config):
+    """Build a scheduler from the scheduler section of the config file
+
+    Parameters
+    ----------
+    config: dict
+        Scheduler section of config.yml
+
+    Returns
+    -------
+    Scheduler
+    """
+    default_duration = datetime.timedelta(seconds=config['default_duration'])
+    overnight_start = datetime.datetime.strptime(config['overnight_start'], "%H:%M").time()
+    overnight_end = datetime.datetime.strptime(config['overnight_end'], "%H:%M").time()
+    available = {
+        'fair_share': lambda: FairShare(),
+        'project_priority': lambda: ProjectPriority(config['project_priorities'], len(config['project_priorities'])),
+        'overnight_packing': lambda: OvernightPacking(overnight_start, overnight_end,
+                                                      datetime.timedelta(seconds=config['long_job']), default_duration),
+        'shortest_job_first': lambda: ShortestJobFirst(datetime.timedelta(seconds=config['max_wait']),
+                                                       default_duration),
+        'first_come_first_served': lambda: FirstComeFirstServed()
+    }
+    return Scheduler([available[policy]() for policy in config['policies']])
@@ -1,5 +1,12 @@
+import json
 import logging
 import os
+import random
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import yaml
 
@@ -7,22 +14,80 @@ logging.basicConfig(filename='Supervisor.log', level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
 
 try:
+    import GcodeAnalyser
+    import GcodeCache
+    import GcodeStream
+    import Mailer
+    import Metrics
     import QueueInterface
+    import Scheduler
 except ImportError:
+    from app import GcodeAnalyser
+    from app import GcodeCache
+    from app import GcodeStream
+    from app import Mailer
+    from app import Metrics
     from app import QueueInterface
+    from app import Scheduler
 
 import octorest
-from requests.exceptions import ConnectionError
+import requests
+import websocket
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 
 with open('config.yml') as yaml_config:
     config = yaml.safe_load(yaml_config)
-    logging.debug(config)
+
+update_seconds = Metrics.Histogram("printer_update_seconds", "Time taken to fetch a printer's status")
+tick_seconds = Metrics.Histogram("tick_seconds", "Time taken to check every printer and plan their next prints")
+prints_started = Metrics.Counter("prints_started_total", "Prints sent to a printer and started")
+prints_finished = Metrics.Counter("prints_finished_total", "Prints found finished on a printer, by outcome")
+dispatch_errors = Metrics.Counter("dispatch_errors_total", "Dispatches which failed with an unexpected error")
+printers_idle = Metrics.Gauge("printers_idle", "Operational printers with nothing to print at the last check")
+reconnects = Metrics.Counter("printer_reconnects_total", "Attempts to reconnect to offline printers, by outcome")
+idle_seconds = Metrics.Counter("printer_idle_seconds_total", "Time printers have spent operational with nothing to "
+                                                             "print, summed over every printer")
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """Transport adapter applying default connect and read deadlines to every request sent through a session
+
+    Octorest doesn't set a timeout on its requests, so without this an unresponsive server can block indefinitely
+    """
+
+    def __init__(self, timeout, *args, **kwargs):
+        """
+        Args:
+            timeout: tuple
+                (connect, read) timeout in seconds, as accepted by requests
+        """
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class JobState:
+    """Stages of handling print jobs on a printer, tracked alongside Octoprint's own printer state"""
+    IDLE = "Idle"
+    CLAIMING = "Claiming"
+    TRANSFERRING = "Transferring"
+    PRINTING = "Printing"
+    AWAITING_CLEARANCE = "Awaiting Clearance"
+
+
+# Octoprint states in which the printer is still working on the file it was given
+ACTIVE_STATES = ("Printing", "Paused", "Pausing", "Resuming", "Cancelling", "Finishing")
 
 
 class Printer:
     """Acts as simplified interface for the OctoREST module for each printer"""
 
-    def __init__(self, name=None, printer_type=None, url=None, apikey=None):
+    def __init__(self, name=None, printer_type=None, url=None, apikey=None, connect=True):
         """
         Args:
             name: String
@@ -33,6 +98,9 @@ class Printer:
                 URL or IP address pointing to the octoprint instance on the network
             apikey: String
                 Octoprint API key
+            connect: bool
+                Connect to the server straight away - if False, connect() or update_state() connects later instead, so
+                many printers can be connected at once
         """
         self.name = name
         self.type = printer_type
@@ -40,9 +108,20 @@ class Printer:
         self.apikey = apikey
 
         self.state = None
+        self.status = {}
+        self.job_state = JobState.IDLE
         self.client = None
+        # Reconnection attempts which have failed in a row, and when the next may be made (monotonic time)
+        self.failures = 0
+        self.retry_at = 0
+
+        if connect:
+            self.connect()
 
-        self.start_client()
+    def connect(self):
+        """Connect to the Octoprint server and fetch the printer's state"""
+        if not self.start_client():
+            self.back_off()
         self.update_state()
 
     def start_client(self):
@@ -53,10 +132,13 @@ class Printer:
         bool
             True if connection successful, false if not
         """
+        session = requests.Session()
+        session.mount("http://", TimeoutAdapter((config['printers']['connect_timeout'],
+                                                 config['printers']['read_timeout'])))
         try:
-            self.client = octorest.OctoRest(url="http://" + self.url, apikey=self.apikey)
+            self.client = octorest.OctoRest(url="http://" + self.url, apikey=self.apikey, session=session)
             return True
-        except (ConnectionError, RuntimeError) as e:
+        except (ConnectionError, Timeout, RuntimeError) as e:
             self.state = "Octoprint Offline"
             logging.warning(f"Server {self.url} offline: {e}")
             return False
@@ -80,14 +162,74 @@ class Printer:
         """
         if self.state == "Invalid":
             return False
-        if self.state == "Octoprint Offline":
-            if not force or (force and not self.start_client()):
+        if self.state is None and self.client is None:
+            # Never connected
+            if not self.start_client():
+                self.back_off()
                 return False
-        printer_status = self.get_full_status()
+        elif self.state == "Octoprint Offline":
+            if not force or not self.reconnect():
+                return False
+        with update_seconds.time():
+            printer_status = self.get_full_status()
         logging.debug(printer_status)
+        self.status = printer_status  # Kept for anything else wanting e.g. temperatures, to save another request
+        if printer_status['state']['text'] == "Octoprint Offline" and self.state != "Octoprint Offline":
+            self.back_off()
         self.state = printer_status['state']['text']  # Octoprint internal state string
         return True
 
+    def probe(self):
+        """Check whether anything is accepting connections at the server's address
+
+        Much cheaper than building a client, which waits for a full request to be answered.
+        """
+        address = urllib.parse.urlsplit("http://" + self.url)
+        try:
+            with socket.create_connection((address.hostname, address.port or 80),
+                                          config['printers']['probe_timeout']):
+                return True
+        except (OSError, ValueError):
+            return False
+
+    def reconnect(self):
+        """Try to reconnect to the offline server, unless the last attempt was too recent
+
+        Returns
+        -------
+        bool
+            True if reconnected
+        """
+        if time.monotonic() < self.retry_at:
+            reconnects.inc(outcome="skipped")
+            return False
+        if not self.probe():
+            reconnects.inc(outcome="unreachable")
+        elif not self.start_client():
+            reconnects.inc(outcome="failed")
+        else:
+            reconnects.inc(outcome="connected")
+            self.reset_backoff()
+            # Otherwise the status would still be reported as offline without asking the server
+            self.state = None
+            return True
+        self.back_off()
+        return False
+
+    def back_off(self):
+        """Put off reconnecting after a failure, for twice as long after each failure in a row up to a limit
+
+        The delay is jittered so printers which went offline together, e.g. in a power cut, don't all retry at once.
+        """
+        delay = min(config['printers']['retry_delay'] * 2 ** self.failures, config['printers']['max_retry_delay'])
+        self.failures += 1
+        self.retry_at = time.monotonic() + random.uniform(delay / 2, delay)
+
+    def reset_backoff(self):
+        """Allow reconnecting straight away, e.g. once the server is known to be back"""
+        self.failures = 0
+        self.retry_at = 0
+
     def get_full_status(self):
         """Retrieve the full status output from Octoprint
 
@@ -102,7 +244,7 @@ class Printer:
         if self.state not in ("Octoprint Offline", "Invalid"):
             try:
                 return self.client.printer()
-            except ConnectionError:
+            except (ConnectionError, Timeout):
                 return {'state': {'text': "Octoprint Offline"}}  # Emulate the format of the octoprint output
             except RuntimeError:
                 return {'state': {'text': "Printer Offline"}}
@@ -121,93 +263,706 @@ class Printer:
         """
         return self.get_full_status()['temperature']
 
+    def get_job_status(self):
+        """Retrieve information about the current job from Octoprint
+
+        See https://docs.octoprint.org/en/master/api/job.html#retrieve-information-about-the-current-job for full details
+
+        Returns
+        -------
+        dict
+            See above documentation
+            None if printer offline or invalid configuration
+        """
+        if self.state in ("Octoprint Offline", "Invalid"):
+            return None
+        try:
+            return self.client.job_info()
+        except (ConnectionError, Timeout, RuntimeError, AttributeError):
+            return None
+
+
+class EventListener(threading.Thread):
+    """Background thread receiving push events from an Octoprint server, so the supervisor can react to a printer as
+    soon as its state changes instead of waiting for the next poll
+
+    Reconnects whenever the connection drops, e.g. while the server is offline.
+    """
+
+    # Events after which the printer may be ready for its next print
+    WAKE_EVENTS = {"PrinterStateChanged", "PrintDone", "PrintFailed", "PrintCancelled"}
+
+    def __init__(self, printer, wake):
+        """
+        Args:
+            printer: Printer
+                Printer whose server to listen to
+            wake: threading.Event
+                Set whenever the printer's state may have changed
+        """
+        super().__init__(name=f"Events {printer.url}", daemon=True)
+        self.printer = printer
+        self.wake = wake
+        self.stopped = threading.Event()
+        self.socket = None
+
+    def login(self):
+        """Start a passive session on the server, which the push API needs to authenticate
+
+        Returns
+        -------
+        str
+            Authentication message payload for the socket
+        """
+        response = requests.post(f"http://{self.printer.url}/api/login", json={'passive': True},
+                                 headers={'X-Api-Key': self.printer.apikey},
+                                 timeout=(config['printers']['connect_timeout'], config['printers']['read_timeout']))
+        if response.status_code != 200:
+            raise RuntimeError(f"Login failed with status {response.status_code}")
+        return f"{response.json()['name']}:{response.json()['session']}"
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Offline servers are only retried on the printer's backoff schedule, shared with the supervisor's own
+            # reconnects, and only logged into once something is accepting connections again
+            delay = self.printer.retry_at - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+                continue
+            if not self.printer.probe():
+                self.printer.back_off()
+                continue
+            try:
+                auth = self.login()
+                self.socket = websocket.WebSocketApp(f"ws://{self.printer.url}/sockjs/websocket",
+                                                     on_open=lambda socket: self.on_open(socket, auth),
+                                                     on_message=self.on_message)
+                self.socket.run_forever(ping_interval=config['supervisor']['event_reconnect_interval'])
+            except (ConnectionError, Timeout, RuntimeError, ValueError, websocket.WebSocketException) as e:
+                logging.debug(f"Event connection to {self.printer.url} failed: {e}")
+            self.stopped.wait(config['supervisor']['event_reconnect_interval'])
+
+    def on_open(self, socket, auth):
+        socket.send(json.dumps({'auth': auth}))
+        # Only events are needed, so slow the regular status messages down to the least often allowed (every minute)
+        socket.send(json.dumps({'throttle': 120}))
+        logging.debug(f"Listening for events from {self.printer.url}")
+        # Anything could have happened while disconnected, and the server may have only just come back online
+        self.printer.reset_backoff()
+        self.printer.update_state(True)
+        self.wake.set()
+
+    def on_message(self, socket, message):
+        event = json.loads(message).get('event')
+        if event is None or event['type'] not in self.WAKE_EVENTS:
+            return
+        logging.debug(f"Event from {self.printer.url}: {event}")
+        if event['type'] == "PrinterStateChanged" and self.printer.state not in ("Octoprint Offline", "Invalid"):
+            self.printer.state = event['payload']['state_string']
+        self.wake.set()
+
+    def stop(self):
+        self.stopped.set()
+        if self.socket is not None:
+            self.socket.close()
+
+
+class PrinterRegistry:
+    """Follows the printers table, only reading it again when its checksum changes
+
+    The checksum is only kept once the caller has applied what it read, so changes which fail partway through being
+    applied are read again next time rather than lost.
+    """
+
+    def __init__(self, queue):
+        """
+        Args:
+            queue: QueueInterface
+                Interface to read the printers table through
+        """
+        self.queue = queue
+        self.checksum = None
+        # Checksum of the rows last read, not yet applied
+        self.pending = None
+
+    def refresh(self, force=False):
+        """Read the printers table if it has changed since the last refresh
+
+        Parameters
+        ----------
+        force: bool
+            Read the table even if it hasn't changed, e.g. to retry applying changes which had to wait
+
+        Returns
+        -------
+        list
+            Rows from QueueInterface.get_all_printer_details, or None if nothing has changed
+        """
+        checksum = self.queue.get_printers_checksum()
+        if checksum == self.checksum and not force:
+            return None
+        printer_details = self.queue.get_all_printer_details()
+        self.pending = checksum
+        return printer_details
+
+    def applied(self):
+        """Note that the rows last read have been applied, so they aren't read again until the table changes"""
+        self.checksum = self.pending
+
+
+def filament_used(file):
+    """Grams of filament Octoprint's analysis of a file says it uses, or 0 if it hasn't been analysed"""
+    lengths = file.get('gcodeAnalysis', {}).get('filament', {})
+    return round(GcodeAnalyser.filament_weight(sum(tool['length'] for tool in lengths.values()),
+                                               config['analyser']['filament_diameter'],
+                                               config['analyser']['filament_density']), 1)
+
+
+def reconcile_printers(found, prints, work):
+    """Work out how to bring the queue into line with what the printers are actually doing, e.g. after a crash
+
+    Each print is settled by what is on its printer: one being printed is running, a finished file gives the outcome,
+    and a file which was never printed is queued again. Prints left running or claimed with no trace on their printer
+    are failed or queued again respectively. Printers with a failed print are held until it has been cleared away.
+    Prints on printers which couldn't be reached are left alone.
+
+    Parameters
+    ----------
+    found: dict
+        Printer ID: (files in its working folder by print ID, ID of the print it is working on or None)
+    prints: dict
+        Print ID: (print status, assigned printer) of every print found on a printer, and every print claimed by or
+        running on one
+    work: UnitOfWork
+        Print state changes are recorded here
+
+    Returns
+    -------
+    dict
+        Printer ID: (names of files to remove, ID of a failed print to hold the printer for clearance of, or None)
+    """
+    actions = {}
+    settled = set()
+    for printer_id, (files, active) in found.items():
+        held = None
+        if active in prints:
+            settled.add(active)
+            status, assigned = prints[active]
+            if status in ("Queued", "Claimed") or (status == "Running" and assigned != printer_id):
+                logging.warning(f"Print ID#{active} is printing on printer {printer_id}, marking as running")
+                work.mark_running(active, printer_id)
+        for print_id, file in files.items():
+            if print_id == active:
+                continue
+            settled.add(print_id)
+            status = prints.get(print_id, (None, None))[0]
+            if status not in ("Claimed", "Running"):
+                # Already finished, or not from the queue, so the file is just left over
+                continue
+            if not file.get('prints'):
+                logging.warning(f"Print ID#{print_id} never started on printer {printer_id}, queueing again")
+                work.mark_queued(print_id)
+            elif file['prints']['success']:
+                logging.warning(f"Print ID#{print_id} on printer {printer_id} found complete")
+                work.mark_complete(print_id, printer_id, int(file['prints']['last']['printTime']),
+                                   filament_used(file))
+            else:
+                logging.warning(f"Print ID#{print_id} on printer {printer_id} found failed")
+                work.mark_failed(print_id, printer_id)
+                held = print_id
+        # A busy printer is already holding its bed, so there's no need to pause it
+        actions[printer_id] = ([file['name'] for print_id, file in files.items() if print_id != active],
+                               held if active is None else None)
+    for print_id, (status, assigned) in prints.items():
+        if print_id in settled or assigned not in found:
+            continue
+        if status == "Claimed":
+            logging.warning(f"Print ID#{print_id} was claimed but never sent to printer {assigned}, queueing again")
+            work.mark_queued(print_id)
+        elif status == "Running":
+            logging.warning(f"Print ID#{print_id} is no longer on printer {assigned}, marking as failed")
+            work.mark_failed(print_id, assigned)
+            # Whatever it left on the bed still needs removing before the next print
+            filenames, held = actions[assigned]
+            if held is None and found[assigned][1] is None:
+                actions[assigned] = (filenames, print_id)
+    return actions
+
 
 class Supervisor:
     """Interface to monitor and control a large number of printers"""
 
-    def __init__(self):
+    def __init__(self, queue_factory=QueueInterface.QueueInterface):
+        """
+        Args:
+            queue_factory: callable
+                Creates a queue interface, called once for each thread needing its own
+        """
         # Connect to queue and populate array of printers
-        self.queue = QueueInterface.QueueInterface()
+        self.queue_factory = queue_factory
+        self.queue = queue_factory()
         self.printers = {}
+        # Set by event listeners whenever a printer may need attention
+        self.wake = threading.Event()
+        self.listeners = {}
+        # Printer polling runs concurrently so one unresponsive server can't hold up the rest of the farm
+        self.poll_pool = ThreadPoolExecutor(max_workers=config['supervisor']['poll_workers'])
+        self.polls = {}
+        # A forced update may reconnect (one request) then fetch status (another), each bounded by the timeouts
+        self.poll_deadline = 2 * (config['printers']['connect_timeout'] + config['printers']['read_timeout'])
+        # Job dispatches also run concurrently, each worker with its own queue interface
+        self.dispatch_pool = ThreadPoolExecutor(max_workers=config['supervisor']['dispatch_workers'])
+        self.dispatches = {}
+        self.last_check = time.monotonic()
+        self.worker_queues = threading.local()
+        # Print state changes are collected here by the workers and written in one go at the end of each tick
+        self.work = QueueInterface.UnitOfWork()
+        self.scheduler = Scheduler.from_config(config['scheduler'])
+        self.registry = PrinterRegistry(self.queue)
+        # Set when a change to the printers table couldn't be applied yet, so it's tried again on the next refresh
+        self.registry_pending = False
+        # When supervisors share the farm, each only looks after the printers it holds leases on
+        self.node = None
+        self.leased = None
+        # Printers held as of the last heartbeat, which runs on its own thread so slow printers can't delay it
+        self.held = None
+        # Printers reconcile is working on, which mustn't be given up to another supervisor meanwhile
+        self.reconciling = set()
+        # Held while working out which printers are busy and renewing leases, and while claiming prints and registering
+        # their dispatches, so a printer can't be given up between its print being claimed and its dispatch starting
+        self.lease_lock = threading.Lock()
+        if config['supervisor']['shared']:
+            self.node = os.environ.get('SUPERVISOR_NODE', socket.gethostname())
+            self.lease_queue = queue_factory()
+            self.heartbeat()
+            self.apply_leases()
         self.refresh_printers()
+        # Keep upcoming prints downloaded while printers are busy, using a separate interface as Drive clients can't
+        # be shared between threads
+        self.prefetcher = GcodeCache.Prefetcher(queue_factory(),
+                                                lambda: set(printer.type for printer in self.printers.values()),
+                                                config['cache']['prefetch_count'], config['cache']['prefetch_interval'])
+        self.prefetcher.start()
+        # Work out how long prints will take and how much filament they need before they are started
+        self.analyser = GcodeAnalyser.Analyser(queue_factory(), config['analyser'])
+        self.analyser.start()
+        self.mailer = None
+        if config['email']['notifications']:
+            self.mailer = Mailer.MailWorker(queue_factory(), config['email'])
+            self.mailer.start()
+        if self.node is not None:
+            threading.Thread(target=self.keep_leases, name="Leases", daemon=True).start()
 
     def refresh_printers(self):
-        """Refreshes the dict of printers, updating their state if they've already been registered"""
-        printer_details = self.queue.get_all_printer_details()
-        for printer in printer_details:
-            if printer[4] is not None:
-                if printer[0] not in self.printers:
-                    self.printers[printer[0]] = Printer(printer[1], printer[2], printer[3], printer[4])
+        """Apply any changes to the printers table since the last refresh
+
+        New printers are connected in the background on the polling pool, so startup doesn't wait on each server in
+        turn. They aren't polled again or given prints until connected. Removed printers are dropped, and printers
+        whose address or API key changed are reconnected, leaving every other connection alone. A printer with a
+        dispatch or poll still running is left as it is until the next refresh.
+        """
+        printer_details = self.registry.refresh(self.registry_pending)
+        if printer_details is None:
+            return
+        details = {printer[0]: printer[1:] for printer in printer_details
+                   if printer[4] is not None and (self.leased is None or printer[0] in self.leased)}
+        self.registry_pending = False
+        printers = {}
+        for printer_id, printer in self.printers.items():
+            current = details.get(printer_id)
+            if current is not None and (current[2], current[3]) == (printer.url, printer.apikey):
+                printer.name, printer.type = current[0], current[1]
+                printers[printer_id] = printer
+                continue
+            if any(not task.done() for task in (self.dispatches.get(printer_id), self.polls.get(printer_id)) if task):
+                self.registry_pending = True
+                printers[printer_id] = printer
+                continue
+            listener = self.listeners.pop(printer_id, None)
+            if listener is not None:
+                listener.stop()
+            self.polls.pop(printer_id, None)
+            if current is None:
+                logging.info(f"Dropping printer {printer_id}, removed or now held by another supervisor")
+                self.dispatches.pop(printer_id, None)
+                continue
+            logging.info(f"Printer {printer_id} address or API key changed, reconnecting")
+            printer.name, printer.type, printer.url, printer.apikey = current
+            printer.client = None
+            printer.state = None
+            printers[printer_id] = printer
+            self.polls[printer_id] = self.poll_pool.submit(self.connect_printer, printer_id, printer)
+        for printer_id, current in details.items():
+            if printer_id not in printers:
+                printers[printer_id] = Printer(*current, connect=False)
+                self.polls[printer_id] = self.poll_pool.submit(self.connect_printer, printer_id, printers[printer_id])
+        # Replaced rather than changed in place, as other threads iterate over it
+        self.printers = printers
+        self.registry.applied()
+
+    def dispatching(self):
+        """IDs of printers with a dispatch in progress"""
+        return {printer_id for printer_id, dispatch in dict(self.dispatches).items() if not dispatch.done()}
+
+    def heartbeat(self):
+        """Renew this supervisor's printer leases and take its share of the farm
+
+        Printers with a dispatch in progress or being reconciled are never given up, so a print can't be started on a
+        printer by two supervisors at once. Claims also check the lease, in case a dispatch starts after its printer
+        has been given up but before apply_leases has dropped it.
+        """
+        with self.lease_lock:
+            busy = self.dispatching() | self.reconciling
+            self.held = self.lease_queue.update_leases(self.node, config['supervisor']['lease_time'], busy)
+
+    def keep_leases(self):
+        """Heartbeat every heartbeat_interval, however long the main loop is held up waiting on printers
+
+        Claims left stale, e.g. on printers which couldn't be reached when they were taken over from a supervisor
+        which stopped, are released every claim_check_interval.
+        """
+        next_claim_check = time.monotonic() + config['supervisor']['claim_check_interval']
+        while True:
+            time.sleep(config['supervisor']['heartbeat_interval'])
+            try:
+                self.heartbeat()
+                if time.monotonic() >= next_claim_check:
+                    next_claim_check = time.monotonic() + config['supervisor']['claim_check_interval']
+                    self.lease_queue.release_stale_claims(self.dispatching() | self.reconciling)
+            except Exception as e:
+                logging.warning(f"Renewing printer leases failed: {e}")
+                continue
+            if self.held != self.leased:
+                self.wake.set()
+
+    def apply_leases(self):
+        """Drop printers given up at the last heartbeat, and connect to and reconcile newly leased ones"""
+        held = self.held
+        if held != self.leased:
+            # Everything is reconciled at startup, so only printers taken over later need it here
+            taken = held - self.leased if held is not None and self.leased is not None else set()
+            self.leased = held
+            self.registry_pending = True
+            self.refresh_printers()
+            if taken:
+                # Whatever the printers' last supervisor left half done, e.g. claims it never sent, is settled before
+                # they are given new prints
+                self.reconcile(taken)
+
+    def connect_printer(self, printer_id, printer):
+        """Connect to a new or changed printer and start listening for its events"""
+        printer.connect()
+        if printer.state != "Invalid":
+            self.listeners[printer_id] = EventListener(printer, self.wake)
+            self.listeners[printer_id].start()
+        # The printer may be ready for a print straight away
+        self.wake.set()
+
+    def inspect_printer(self, printer):
+        """Get the prints in a printer's working folder and the one it is working on, for reconcile
+
+        Returns
+        -------
+        tuple
+            (file details from Octoprint by print ID, ID of the print being worked on or None)
+        """
+        try:
+            children = printer.client.files(config['printers']['working_folder'], True)['children']
+        except RuntimeError:
+            # No working folder yet, so nothing has been printed
+            children = []
+        files = {int(file['name'].split('.')[0]): file for file in children if file['name'].split('.')[0].isdigit()}
+        active = None
+        if printer.state in ACTIVE_STATES:
+            job = printer.get_job_status()
+            name = job['job']['file']['name'] if job is not None else None
+            if name is not None and name.split('.')[0].isdigit():
+                active = int(name.split('.')[0])
+        return files, active
+
+    def reconcile(self, printer_ids=None):
+        """Bring prints left running or claimed by an earlier run into line with the printers, e.g. after a crash
+
+        Every connected printer is inspected at once, the differences from the queue are worked out in one go and
+        written in one transaction, then any finished files are removed from the printers, again all at once. Stale
+        claims on printers which couldn't be inspected are released afterwards.
+
+        Leases keep being renewed in the background meanwhile, and the printers being reconciled aren't given up.
+
+        Parameters
+        ----------
+        printer_ids: set
+            Printers to reconcile, e.g. ones just taken over from another supervisor, or None for every printer
+        """
+        printers = {printer_id: printer for printer_id, printer in self.printers.items()
+                    if printer_ids is None or printer_id in printer_ids}
+        with self.lease_lock:
+            self.reconciling = set(printers)
+        try:
+            # Printers are connected in the background, so wait for that to finish first
+            wait(list(self.polls.values()), timeout=self.poll_deadline)
+            inspections = {printer_id: self.poll_pool.submit(self.inspect_printer, printer)
+                           for printer_id, printer in printers.items()
+                           if printer.client is not None and printer.state not in ("Octoprint Offline", "Invalid")}
+            done, not_done = wait(inspections.values(), timeout=self.poll_deadline)
+            found = {}
+            for printer_id, inspection in inspections.items():
+                if inspection in not_done:
+                    logging.warning(f"Printer {printer_id} did not respond within {self.poll_deadline}s, leaving its "
+                                    f"prints as they are")
+                elif inspection.exception() is not None:
+                    logging.warning(f"Couldn't inspect printer {printer_id}, leaving its prints as they are: "
+                                    f"{inspection.exception()}")
                 else:
-                    self.printers[printer[0]].update_state(True)
+                    found[printer_id] = inspection.result()
+            prints = self.queue.get_unfinished_prints(found, {print_id for files, active in found.values()
+                                                              for print_id in [*files, active] if print_id is not None})
+            actions = reconcile_printers(found, prints, self.work)
+            self.commit_work()
+            # Only once the claims on the printers inspected are settled, as a claim left stale can still have reached
+            # its printer, and shouldn't be queued again if it did
+            self.queue.release_stale_claims(set(found) | self.dispatching())
+            for printer_id, (files, active) in found.items():
+                if active is not None:
+                    self.printers[printer_id].job_state = JobState.PRINTING
+            cleanups = {printer_id: self.poll_pool.submit(self.clear_printer, self.printers[printer_id], *action)
+                        for printer_id, action in actions.items() if action[0] or action[1] is not None}
+            done, not_done = wait(cleanups.values(), timeout=self.poll_deadline)
+            for printer_id, cleanup in cleanups.items():
+                if cleanup in not_done or cleanup.exception() is not None:
+                    logging.warning(f"Couldn't clear finished prints from printer {printer_id}: "
+                                    f"{'timed out' if cleanup in not_done else cleanup.exception()}")
+            logging.info(f"Reconciled {len(found)} of {len(printers)} printers with the queue")
+        finally:
+            self.reconciling = set()
+
+    def clear_printer(self, printer, filenames, held):
+        """Remove finished files from a printer's working folder, holding it for clearance if a print failed"""
+        if held is not None:
+            self.hold_for_clearance(printer, held)
+        for filename in filenames:
+            printer.client.delete(f"local/{config['printers']['working_folder']}/{filename}")
+
+    def hold_for_clearance(self, printer, print_id):
+        """Pause a printer after a failed print, so it isn't given another until the failed one has been removed"""
+        # Send gcode containing only pause to printer, allowing print to be removed before continuing
+        pause_gcode = f"\nM117 ID#{print_id} failed\nM0\nM117 Idle\n".encode()
+        GcodeStream.upload(printer.client, "0.gcode", [pause_gcode], len(pause_gcode), select=True, start=True)
+        # Octoprint's state only catches up later, so don't treat the printer as free until it does
+        printer.state = "Printing"
+        printer.job_state = JobState.AWAITING_CLEARANCE
 
     def update_printer_states(self, force=False):
-        """Just update the state of all active printers"""
-        for printer in self.printers:
-            self.printers[printer].update_state(force)
+        """Just update the state of all active printers
+
+        Printers are polled concurrently. A printer whose previous poll is still outstanding isn't polled again, and
+        any poll which overruns the deadline is left to finish in the background so it can't delay the sweep.
+
+        Parameters
+        ----------
+        force: bool
+            Passed to Printer.update_state
+        """
+        for printer_id, printer in self.printers.items():
+            if printer_id in self.polls and not self.polls[printer_id].done():
+                logging.debug(f"Printer {printer_id} still polling, skipping")
+                continue
+            self.polls[printer_id] = self.poll_pool.submit(printer.update_state, force)
+        done, not_done = wait(self.polls.values(), timeout=self.poll_deadline)
+        for printer_id, poll in self.polls.items():
+            if poll in not_done:
+                logging.warning(f"Printer {printer_id} did not respond within {self.poll_deadline}s")
+            elif poll.exception() is not None:
+                logging.warning(f"Printer {printer_id} poll failed: {poll.exception()}")
 
     def check_printer_states(self):
-        """Check all active printers, start next print job if last one complete"""
-        for printer_id in self.printers:
-            printer = self.printers[printer_id]
+        """Check all active printers, dispatching the next print job to any which have finished their last one
+
+        Dispatches run on a worker pool, so transfers to several printers can happen at once while the rest of the
+        farm keeps being checked. The queue is read and planned prints claimed with a fixed number of queries however
+        many printers are ready.
+        """
+        with tick_seconds.time():
+            self.plan_prints()
+
+    def plan_prints(self):
+        """Find which printers are ready for their next print, then plan, claim and dispatch them"""
+        ready = {}
+        idle = 0
+        for printer_id, printer in self.printers.items():
+            dispatch = self.dispatches.get(printer_id)
+            if dispatch is not None:
+                if not dispatch.done():
+                    continue
+                if dispatch.exception() is not None:
+                    logging.error(f"Dispatch to printer {printer_id} failed: {dispatch.exception()}")
+                    dispatch_errors.inc()
+                    printer.job_state = JobState.IDLE
             if printer.state == "Operational":
-                try:
-                    # Check whether there was a print - if so, mark as complete or failed and remove from printer
-                    try:
-                        folder = printer.client.files(config['printers']['working_folder'], True)
-                    except RuntimeError:
-                        printer.client.create_folder(config['printers']['working_folder'])
-                        folder = printer.client.files(config['printers']['working_folder'], True)
-                    logging.debug(folder)
-                    finished_print_id = folder['children'][0]['name'].split('.')[0]
-                    if folder['children'][0]['prints']['success']:
-                        print(f"Print ID#{finished_print_id} on printer {printer_id} complete")
-                        self.queue.mark_complete(finished_print_id, printer_id, int(folder['children'][0]['prints']['last']['printTime']), int(3 * folder['children'][0]['gcodeAnalysis']['filament']['tool0']['length']))
-                        printer.client.delete(f"local/{config['printers']['working_folder']}/{finished_print_id}.gcode")
-                    else:
-                        print(f"Print ID#{finished_print_id} on printer {printer_id} failed")
-                        self.queue.mark_failed(finished_print_id)
-                        # Send gcode containing only pause to printer, allowing print to be removed before continuing
-                        with open("0.gcode", "w") as pause_gcode:
-                            pause_gcode.write(f"\nM117 ID#{finished_print_id} failed\nM0\nM117 Idle\n")
-                        printer.client.upload("0.gcode")
-                        printer.client.select("0.gcode", print=True)
-                        printer.client.delete(f"local/{config['printers']['working_folder']}/{finished_print_id}.gcode")
-                        continue
-                except IndexError:
-                    # No file found in folder
-                    pass
-                # Get ID of next print for current printer type
-                next_print_id = self.queue.get_next_print(printer.type)
-                if next_print_id != 0:
-                    next_print = self.queue.download_file(next_print_id, str(next_print_id) + ".gcode")
-                    # Inject pause at end of print
-                    with open(next_print, 'a') as print_gcode:
-                        print_gcode.write("\nM0; Pause to allow user to confirm completion or failure\n")
-                    # Upload next print and move to the operating folder
-                    printer.client.upload(next_print)
-                    printer.client.move(f"{str(next_print_id)}.gcode",
-                                        f"{config['printers']['working_folder']}/{str(next_print_id)}.gcode")
-                    # Select and start print
-                    print(f"Starting print ID#{next_print_id} on printer {printer_id}")
-                    printer.client.select(f"{config['printers']['working_folder']}/{str(next_print_id)}.gcode",
-                                          print=True)
-                    # Mark as running
-                    self.queue.mark_running(next_print_id, printer_id)
-                    os.remove(f"{str(next_print_id)}.gcode")
+                ready[printer_id] = printer
+                if printer.job_state == JobState.IDLE:
+                    idle += 1
+        now = time.monotonic()
+        printers_idle.set(idle)
+        idle_seconds.inc(idle * (now - self.last_check))
+        self.last_check = now
+        if not ready:
+            return
+        # Plan the next print for every ready printer at once, from a single snapshot of the queue, and claim them all
+        # together so no other supervisor can start them too
+        plans = self.scheduler.assign(self.queue.get_queue_snapshot(),
+                                      {printer_id: printer.type for printer_id, printer in ready.items()})
+        with self.lease_lock:
+            claimed = self.queue.claim_prints({printer_id: job.id for printer_id, job in plans.items()}, self.node)
+            for printer_id in ready:
+                self.dispatches[printer_id] = self.dispatch_pool.submit(self.dispatch, printer_id,
+                                                                        printer_id in plans, claimed.get(printer_id))
 
+    def commit_work(self):
+        """Write the print state changes dispatches have made since the last tick to the queue, in one transaction"""
+        finished = bool(self.work.complete or self.work.failed)
+        if self.queue.commit_work(self.work) and finished and self.mailer is not None:
+            # Emails about finished prints are in the outbox now, so send them without waiting for the next poll
+            self.mailer.wake.set()
 
-if __name__ == "__main__":
-    import time
+    def worker_queue(self):
+        """Get the queue interface belonging to the current dispatch worker, as Drive clients aren't thread-safe"""
+        if not hasattr(self.worker_queues, 'queue'):
+            self.worker_queues.queue = self.queue_factory()
+        return self.worker_queues.queue
+
+    def dispatch(self, printer_id, planned, next_print):
+        """Finish off an operational printer's last print job, then start its next one
+
+        State changes are recorded in the supervisor's unit of work, and the main loop is woken to write them.
 
+        Parameters
+        ----------
+        printer_id: int
+            ID of the printer, which must be operational
+        planned: bool
+            Whether the scheduler chose a print for the printer
+        next_print: tuple
+            (id, drive file id, gcode filename) of the print claimed for the printer, or None if the planned print
+            was claimed by someone else first or nothing was queued for it
+        """
+        try:
+            self.start_next_print(printer_id, planned, next_print)
+        except Exception:
+            # Failures during the transfer release their own claim, but anything earlier, e.g. the printer not answering
+            # while its last print was finished off, would otherwise leave the print claimed until the next restart
+            if next_print is not None and self.printers[printer_id].job_state != JobState.TRANSFERRING:
+                self.worker_queue().release_claim(next_print[0])
+            raise
+        finally:
+            self.wake.set()
+
+    def start_next_print(self, printer_id, planned, next_print):
+        printer = self.printers[printer_id]
+        queue = self.worker_queue()
+        try:
+            # Check whether there was a print - if so, mark as complete or failed and remove from printer
+            try:
+                folder = printer.client.files(config['printers']['working_folder'], True)
+            except RuntimeError:
+                printer.client.create_folder(config['printers']['working_folder'])
+                folder = printer.client.files(config['printers']['working_folder'], True)
+            logging.debug(folder)
+            finished = folder['children'][0]
+            finished_print_id = int(finished['name'].split('.')[0])
+            if not finished.get('prints'):
+                # Uploaded but never printed, e.g. the start failed, so it goes back in the queue
+                print(f"Print ID#{finished_print_id} on printer {printer_id} never started")
+                self.work.mark_queued(finished_print_id)
+                printer.client.delete(f"local/{config['printers']['working_folder']}/{finished_print_id}.gcode")
+            elif finished['prints']['success']:
+                print(f"Print ID#{finished_print_id} on printer {printer_id} complete")
+                prints_finished.inc(outcome="complete")
+                self.work.mark_complete(finished_print_id, printer_id, int(finished['prints']['last']['printTime']),
+                                        filament_used(finished))
+                printer.client.delete(f"local/{config['printers']['working_folder']}/{finished_print_id}.gcode")
+            else:
+                print(f"Print ID#{finished_print_id} on printer {printer_id} failed")
+                prints_finished.inc(outcome="failed")
+                self.work.mark_failed(finished_print_id, printer_id)
+                self.hold_for_clearance(printer, finished_print_id)
+                printer.client.delete(f"local/{config['printers']['working_folder']}/{finished_print_id}.gcode")
+                if next_print is not None:
+                    queue.release_claim(next_print[0])
+                return
+        except IndexError:
+            # No file found in folder
+            pass
+        if next_print is None and planned:
+            # Another supervisor claimed the planned print first, so fall back to the next in line
+            printer.job_state = JobState.CLAIMING
+            next_print = queue.claim_next_print(printer.type, printer_id, self.node)
+        if next_print is None:
+            printer.job_state = JobState.IDLE
+            return
+        next_print_id = next_print[0]
+        printer.job_state = JobState.TRANSFERRING
+        try:
+            # Stream the print straight into the printer's working folder, injecting the ID banner and end pause on
+            # the way, then start it
+            gcode, size = GcodeStream.add_job_markers(*queue.stream_file(next_print_id, next_print[1]), next_print_id)
+            print(f"Starting print ID#{next_print_id} on printer {printer_id}")
+            GcodeStream.upload(printer.client, f"{str(next_print_id)}.gcode", gcode, size,
+                               path=config['printers']['working_folder'], select=True, start=True)
+        except (ConnectionError, Timeout, RuntimeError, OSError) as e:
+            logging.warning(f"Failed to start print ID#{next_print_id} on printer {printer_id}: {e}")
+            queue.release_claim(next_print_id)
+            printer.job_state = JobState.IDLE
+            return
+        except Exception:
+            queue.release_claim(next_print_id)
+            raise
+        # Mark as running
+        self.work.mark_running(next_print_id, printer_id)
+        prints_started.inc()
+        printer.state = "Printing"
+        printer.job_state = JobState.PRINTING
+
+
+if __name__ == "__main__":
+    Metrics.limit_logging(config['metrics'])
+    Metrics.registry.prefix = "supervisor"
+    Metrics.serve(config['metrics']['supervisor_port'])
     supervisor = Supervisor()
     logging.debug(supervisor.printers)
+    # Settle anything left half done by the last run before starting new prints
+    try:
+        supervisor.reconcile()
+    except Exception as e:
+        logging.warning(f"Reconciling printers with the queue failed: {e}")
+    next_poll = 0
+    next_refresh = time.monotonic() + config['supervisor']['registry_interval']
     while True:
-        # Check printers and start new prints every set time interval (excluding time spent starting new prints etc.)
-        supervisor.update_printer_states(True)
-        for printer in supervisor.printers:
-            print(f"Printer: '{supervisor.printers[printer].name}'  "
-                  f"Type: '{supervisor.printers[printer].type}'  "
-                  f"State: '{supervisor.printers[printer].state}'")
+        # Follow the printers this supervisor holds, including any taken over from supervisors which have stopped
+        if supervisor.node is not None:
+            try:
+                supervisor.apply_leases()
+            except Exception as e:
+                logging.warning(f"Applying printer leases failed: {e}")
+        # Pick up printers added, removed or changed in the database
+        if time.monotonic() >= next_refresh:
+            next_refresh = time.monotonic() + config['supervisor']['registry_interval']
+            try:
+                supervisor.refresh_printers()
+            except Exception as e:
+                logging.warning(f"Refreshing printers failed: {e}")
+        # Poll every printer at a set interval, as a fallback in case any events were missed
+        if time.monotonic() >= next_poll:
+            next_poll = time.monotonic() + config['supervisor']['update_interval']
+            supervisor.update_printer_states(True)
+            for printer in supervisor.printers:
+                print(f"Printer: '{supervisor.printers[printer].name}'  "
+                      f"Type: '{supervisor.printers[printer].type}'  "
+                      f"State: '{supervisor.printers[printer].state}'  "
+                      f"Job: '{supervisor.printers[printer].job_state}'")
+        # Check printers and start new prints, then wait until a printer's state changes or the next poll is due
+        supervisor.wake.clear()
         supervisor.check_printer_states()
-        time.sleep(config['supervisor']['update_interval'])
+        supervisor.commit_work()
+        next_event = min(next_poll, next_refresh)
+        supervisor.wake.wait(max(0, next_event - time.monotonic()))
@@ -0,0 +1,283 @@
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+
+# One reading of a printer's temperatures and job progress. Anything the printer didn't report is NaN
+SAMPLE = np.dtype([
+    ('time', '<f8'),
+    ('bed', '<f4'), ('bed_target', '<f4'),
+    ('tool0', '<f4'), ('tool0_target', '<f4'),
+    ('tool1', '<f4'), ('tool1_target', '<f4'),
+    ('completion', '<f4'),
+    ('state', '<i2')
+])
+TRANSITION = np.dtype([('time', '<f8'), ('state', '<i2')])
+# Averaged when rolling samples up into a coarser level - the state is taken from the last sample instead
+AVERAGED = [field for field in SAMPLE.names if field not in ('time', 'state')]
+HEADER_SIZE = 64
+
+
+class RingBuffer:
+    """Fixed-size array of records kept in a memory-mapped file, overwriting the oldest once full
+
+    Records must be appended in time order, so ranges can be found by binary search.
+    """
+
+    def __init__(self, path, dtype, capacity):
+        """
+        Args:
+            path: String
+                File to keep the records in, created if missing or recreated if its size doesn't match
+            dtype: numpy.dtype
+                Record type, with a 'time' field
+            capacity: int
+                Number of records kept
+        """
+        self.capacity = capacity
+        size = HEADER_SIZE + dtype.itemsize * capacity
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            if os.path.exists(path):
+                logging.warning(f"Discarding {path} as its size doesn't match the configured capacity")
+            with open(path, 'wb') as file:
+                file.truncate(size)
+        # Total number of records ever appended, so the position of the oldest survives restarts
+        self.header = np.memmap(path, dtype='<i8', mode='r+', shape=(1,))
+        self.records = np.memmap(path, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=(capacity,))
+
+    def __len__(self):
+        return min(int(self.header[0]), self.capacity)
+
+    def append(self, record):
+        self.records[self.header[0] % self.capacity] = record
+        self.header[0] += 1
+
+    def last(self):
+        """The newest record, or None if empty"""
+        if not self.header[0]:
+            return None
+        return self.records[(self.header[0] - 1) % self.capacity]
+
+    def ordered(self):
+        """Copy of every record, oldest first"""
+        return np.concatenate(self.segments())
+
+    def segments(self):
+        """Views of the records in the file, oldest first, as the one or two stretches of the ring they fill"""
+        if self.header[0] <= self.capacity:
+            return self.records[:self.header[0]],
+        head = self.header[0] % self.capacity
+        return self.records[head:], self.records[:head]
+
+    def oldest(self):
+        """Time of the oldest record, or None if empty"""
+        if not self.header[0]:
+            return None
+        return float(self.records[self.header[0] % self.capacity if self.header[0] > self.capacity else 0]['time'])
+
+    def range(self, start, end):
+        """Records with start <= time <= end, oldest first
+
+        Each stretch of the ring is searched where it lies, so only the records in the range are copied.
+        """
+        found = []
+        for segment in self.segments():
+            times = segment['time']
+            found.append(segment[bisect.bisect_left(times, start):bisect.bisect_right(times, end)])
+        return np.concatenate(found)
+
+    def flush(self):
+        self.header.flush()
+        self.records.flush()
+
+
+class Series:
+    """Telemetry of one printer, at full resolution for the recent past and averaged over longer periods further back
+
+    Samples are rolled up into each coarser level as their period ends, so every level has a fixed size on disk and
+    in memory, and queries over long ranges don't have to read every raw sample.
+    """
+
+    def __init__(self, directory, levels, transitions):
+        """
+        Args:
+            directory: String
+                Folder for this printer's files, created if missing
+            levels: list
+                (seconds per record, number of records) of each level, finest first - the first level keeps every
+                sample so its resolution should be 0
+            transitions: int
+                Number of state transitions kept
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.levels = [(resolution, RingBuffer(os.path.join(directory, f"samples_{resolution}.bin"), SAMPLE, capacity))
+                       for resolution, capacity in levels]
+        self.transitions = RingBuffer(os.path.join(directory, "transitions.bin"), TRANSITION, transitions)
+        # Samples in the current period of each coarser level, not yet rolled up
+        self.pending = [[] for _ in levels]
+
+    def record(self, sample):
+        with self.lock:
+            last = self.transitions.last()
+            if last is None or last['state'] != sample['state']:
+                self.transitions.append((sample['time'], sample['state']))
+            for index, (resolution, buffer) in enumerate(self.levels):
+                if not resolution:
+                    buffer.append(sample)
+                    continue
+                pending = self.pending[index]
+                if pending and pending[0]['time'] // resolution != sample['time'] // resolution:
+                    buffer.append(self.roll_up(pending, resolution))
+                    pending.clear()
+                pending.append(sample)
+
+    @staticmethod
+    def roll_up(samples, resolution):
+        samples = np.array(samples, dtype=SAMPLE)
+        record = np.zeros((), dtype=SAMPLE)
+        record['time'] = samples[0]['time'] // resolution * resolution
+        for field in AVERAGED:
+            values = samples[field][~np.isnan(samples[field])]
+            record[field] = values.mean() if len(values) else np.nan
+        record['state'] = samples[-1]['state']
+        return record
+
+    def query(self, start, end, resolution=0):
+        """Get samples between two times from the finest level which still goes back far enough
+
+        Parameters
+        ----------
+        start: float
+            Unix time of the start of the range
+        end: float
+            Unix time of the end of the range
+        resolution: float
+            Coarsest level wanted, in seconds per record - finer levels are skipped
+
+        Returns
+        -------
+        tuple
+            (samples, state transitions) as numpy arrays
+        """
+        with self.lock:
+            candidates = [level for level in self.levels if level[0] >= resolution] or self.levels[-1:]
+            chosen = candidates[0][1]
+            reach = math.inf
+            for level_resolution, buffer in candidates:
+                oldest = buffer.oldest()
+                if oldest is None:
+                    continue
+                if oldest <= start:
+                    chosen = buffer
+                    break
+                # Otherwise the level going back furthest, finest first, e.g. on a fresh install where the coarser
+                # levels are still empty. A coarser level's oldest record may only hold samples from late in its
+                # period, so it has to go back a whole period further to count
+                if oldest + level_resolution < reach:
+                    chosen = buffer
+                    reach = oldest + level_resolution
+            return chosen.range(start, end), self.transitions.range(start, end)
+
+    def flush(self):
+        with self.lock:
+            for _, buffer in self.levels:
+                buffer.flush()
+            self.transitions.flush()
+
+
+class TelemetryStore:
+    """Local store of every printer's temperature, progress and state history, kept out of the queue database"""
+
+    def __init__(self, directory, levels, transitions):
+        """
+        Args:
+            directory: String
+                Folder to keep telemetry in, with a subfolder for each printer
+            levels: list
+                As for Series
+            transitions: int
+                As for Series
+        """
+        self.directory = directory
+        self.levels = levels
+        self.transitions = transitions
+        self.series = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # State strings are stored as their index in this list, which only ever grows
+        self.states_path = os.path.join(directory, "states.json")
+        self.states = []
+        if os.path.exists(self.states_path):
+            with open(self.states_path) as states_file:
+                self.states = json.load(states_file)
+
+    def get_series(self, printer_id):
+        with self.lock:
+            if printer_id not in self.series:
+                self.series[printer_id] = Series(os.path.join(self.directory, str(printer_id)), self.levels,
+                                                 self.transitions)
+            return self.series[printer_id]
+
+    def state_code(self, state):
+        with self.lock:
+            if state not in self.states:
+                self.states.append(state)
+                with open(self.states_path + ".tmp", 'w') as states_file:
+                    json.dump(self.states, states_file)
+                os.replace(self.states_path + ".tmp", self.states_path)
+            return self.states.index(state)
+
+    def record(self, printer_id, status, time):
+        """Add a reading of a printer's status
+
+        Parameters
+        ----------
+        printer_id: int
+        status: dict
+            As returned by StatusPoller.poll
+        time: float
+            Unix time of the reading
+        """
+        sample = np.zeros((), dtype=SAMPLE)
+        sample['time'] = time
+        temperatures = status.get('temperatures') or {}
+        for name in ('bed', 'tool0', 'tool1'):
+            reading = temperatures.get(name) or {}
+            for suffix, key in (('', 'actual'), ('_target', 'target')):
+                value = reading.get(key)
+                sample[name + suffix] = value if value is not None else np.nan
+        completion = (status.get('job') or {}).get('completion')
+        sample['completion'] = completion if completion is not None else np.nan
+        sample['state'] = self.state_code(status.get('state'))
+        self.get_series(printer_id).record(sample)
+
+    def query(self, printer_id, start, end, resolution=0):
+        """Get a printer's telemetry between two times, in a form ready to serialise as JSON
+
+        Returns
+        -------
+        dict
+            'samples': each field as a list, with None where there's no reading, and 'transitions': [time, state]
+            pairs
+        """
+        samples, transitions = self.get_series(printer_id).query(start, end, resolution)
+        with self.lock:
+            states = list(self.states)
+        return {
+            'samples': {field: [None if math.isnan(value) else value for value in samples[field].tolist()]
+                        if field in AVERAGED else samples[field].tolist()
+                        for field in SAMPLE.names if field != 'state'},
+            'states': [states[code] for code in samples['state'].tolist()],
+            'transitions': [[time, states[code]] for time, code in transitions.tolist()]
+        }
+
+    def flush(self):
+        with self.lock:
+            series = list(self.series.values())
+        for printer_series in series:
+            printer_series.flush()
@@ -0,0 +1,236 @@
+import io
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from PIL import Image
+from requests.exceptions import RequestException
+
+try:
+    import Metrics
+except ImportError:
+    from app import Metrics
+
+frames_relayed = Metrics.Counter("webcam_frames_total", "Frames received from cameras, and sent on to viewers")
+upstream_connections = Metrics.Counter("webcam_connections_total", "Connections made to cameras, by outcome")
+
+
+def read_frames(stream):
+    """Split an MJPEG stream, as served by mjpg-streamer, into its JPEG frames
+
+    Parameters
+    ----------
+    stream: file-like
+        Body of a multipart/x-mixed-replace response
+
+    Yields
+    ------
+    bytes
+        Each frame, as it arrives
+
+    Raises
+    ------
+    ValueError
+        If a part doesn't give its length
+    """
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        if not line.startswith(b"--"):
+            # Blank lines between parts
+            continue
+        headers = {}
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            if not line.strip():
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' not in headers:
+            raise ValueError("Stream part has no Content-Length")
+        frame = stream.read(int(headers['content-length']))
+        if len(frame) < int(headers['content-length']):
+            return
+        yield frame
+
+
+class CameraRelay:
+    """One connection to a printer's camera, shared by everyone watching it
+
+    The connection is opened when the first viewer arrives and closed once nobody has watched for a while, so each
+    camera sends one stream however many dashboards are open. Only the newest frame is kept, so a slow viewer skips
+    frames rather than holding up the camera or anyone else.
+    """
+
+    def __init__(self, url, config):
+        """
+        Args:
+            url: String
+                Address of the camera's MJPEG stream
+            config: dict
+                Webcam section of config.yml
+        """
+        self.url = url
+        self.config = config
+        self.condition = threading.Condition()
+        self.frame = None
+        # Number of frames received, so viewers can wait for one they haven't seen
+        self.sequence = 0
+        self.thumbnails = {}  # Width: (sequence, JPEG bytes)
+        self.viewers = 0
+        self.demanded = 0
+        self.running = False
+        # When a camera which couldn't be reached may be tried again (monotonic time)
+        self.retry_at = 0
+
+    def demand(self):
+        """Note that a frame is wanted, starting the connection to the camera if it isn't open
+
+        Returns
+        -------
+        bool
+            False if the camera couldn't be reached recently, so isn't being tried again yet
+        """
+        with self.condition:
+            self.demanded = time.monotonic()
+            if self.running:
+                return True
+            if self.demanded < self.retry_at:
+                return False
+            self.running = True
+        threading.Thread(target=self.run, name=f"Webcam {self.url}", daemon=True).start()
+        return True
+
+    def wait_frame(self, after=0, timeout=None):
+        """Wait for a frame newer than the one last seen
+
+        Parameters
+        ----------
+        after: int
+            Sequence number of the last frame seen, or 0 for the newest frame, waiting only if there isn't one yet
+        timeout: float
+            Seconds to wait, or None to use the configured frame_timeout
+
+        Returns
+        -------
+        tuple
+            (sequence number, JPEG bytes), or (after, None) if no new frame arrived in time
+        """
+        if not self.demand():
+            return after, None
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > after and self.frame is not None or not self.running,
+                                    self.config['frame_timeout'] if timeout is None else timeout)
+            if self.sequence > after and self.frame is not None:
+                return self.sequence, self.frame
+            return after, None
+
+    def thumbnail(self, width):
+        """Newest frame scaled down to a width, for grids of many cameras
+
+        Each frame is only scaled once for each width however many viewers ask for it.
+
+        Returns
+        -------
+        bytes
+            JPEG, or None if no frame arrived in time
+        """
+        sequence, frame = self.wait_frame()
+        if frame is None:
+            return None
+        with self.condition:
+            cached = self.thumbnails.get(width)
+        if cached is not None and cached[0] == sequence:
+            return cached[1]
+        image = Image.open(io.BytesIO(frame))
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            # Lets the JPEG decoder skip detail that would be thrown away, much cheaper than decoding at full size
+            image.draft('RGB', (width, height))
+            image = image.convert('RGB').resize((width, height), Image.BILINEAR)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=self.config['thumbnail_quality'])
+        with self.condition:
+            self.thumbnails[width] = (sequence, output.getvalue())
+        return output.getvalue()
+
+    @contextmanager
+    def watch(self):
+        """Count a viewer of the stream for the duration of the with block, keeping the connection open meanwhile"""
+        with self.condition:
+            self.viewers += 1
+        try:
+            yield self
+        finally:
+            with self.condition:
+                self.viewers -= 1
+                # Closed idle_timeout after the last viewer leaves, as after a snapshot
+                self.demanded = time.monotonic()
+
+    def idle(self):
+        return self.viewers == 0 and time.monotonic() - self.demanded > self.config['idle_timeout']
+
+    def run(self):
+        try:
+            with requests.get(self.url, stream=True, timeout=(self.config['connect_timeout'],
+                                                              self.config['read_timeout'])) as response:
+                response.raise_for_status()
+                upstream_connections.inc(outcome="connected")
+                for frame in read_frames(response.raw):
+                    frames_relayed.inc(direction="received")
+                    with self.condition:
+                        self.frame = frame
+                        self.sequence += 1
+                        self.condition.notify_all()
+                        if self.idle():
+                            break
+        except (RequestException, OSError, ValueError) as e:
+            upstream_connections.inc(outcome="failed")
+            logging.warning(f"Webcam {self.url} unavailable: {e}")
+            with self.condition:
+                self.retry_at = time.monotonic() + self.config['retry_delay']
+        finally:
+            with self.condition:
+                self.running = False
+                # Not kept once the connection closes, so nobody is shown a stale picture
+                self.frame = None
+                self.thumbnails = {}
+                self.condition.notify_all()
+
+
+class CameraRelays:
+    """Camera relay for each printer, made when the printer's camera is first watched"""
+
+    def __init__(self, config):
+        """
+        Args:
+            config: dict
+                Webcam section of config.yml
+        """
+        self.config = config
+        self.relays = {}
+        self.lock = threading.Lock()
+
+    def get(self, printer_id, address):
+        """
+        Parameters
+        ----------
+        printer_id: int
+        address: str
+            Printer's host and port, as in the printers table
+
+        Returns
+        -------
+        CameraRelay
+        """
+        url = f"http://{address}{self.config['stream_path']}"
+        with self.lock:
+            relay = self.relays.get(printer_id)
+            if relay is None or relay.url != url:
+                relay = self.relays[printer_id] = CameraRelay(url, self.config)
+            return relay
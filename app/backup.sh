@@ -1,11 +1,120 @@
 #!/bin/bash
+#
+# Incremental backup of the queue database
+#
+# Each backup set is a full dump followed by the binary logs of every change made since, so after the first run each
+# backup only copies the logs written since the last one. A new set is started once the newest is FULL_DAYS old, and
+# only the newest KEEP_SETS sets are kept. Restore a set with restore.sh.
 
 set -o errexit
 set -o nounset
+set -o pipefail
 
 if [ "$#" -ne "1" ]; then
   echo "Expected 1 arguments, got $#" >&2
   exit 2
 fi
 
-mysqldump queue --single-transaction --user=root --password=${1} > /data/queue_backup.sql
\ No newline at end of file
+#{{{ Variables
+export MYSQL_PWD="${1}"
+backup_dir="${BACKUP_DIR:-/data/backups}"
+full_days="${FULL_DAYS:-7}"
+keep_sets="${KEEP_SETS:-4}"
+#}}}
+
+# Only use the disk and CPU when nothing else wants them, so backups don't hold up the database or the supervisor
+ionice -c 3 -p $$ > /dev/null 2>&1 || true
+renice -n 19 -p $$ > /dev/null 2>&1 || true
+
+#{{{ Functions
+
+sql() {
+  mysql --user=root --batch --skip-column-names --execute="${1}"
+}
+
+# Name of the binary log after the one given, e.g. queue-bin.000042 -> queue-bin.000043
+next_log() {
+  local number="${1##*.}"
+  printf "%s.%0${#number}d" "${1%.*}" $((10#${number} + 1))
+}
+
+# Backup sets, oldest first
+list_sets() {
+  find "${backup_dir}" -mindepth 1 -maxdepth 1 -type d -name "20*" | sort
+}
+
+# Binary log a set needs copied into it next: the one after the last copied, or the one its dump started in
+needed_log() {
+  local newest
+  newest="$(find "${1}" -maxdepth 1 -name "*.[0-9]*.gz" -printf "%f\n" | sort | tail -n 1)"
+  if [ -n "${newest}" ]; then
+    next_log "${newest%.gz}"
+  else
+    cut -d " " -f 1 "${1}/position"
+  fi
+}
+
+full_backup() {
+  local name set
+  name="$(date +%Y%m%d-%H%M%S)"
+  set="${backup_dir}/.${name}"
+  mkdir -p "${set}"
+  # A consistent snapshot without locking tables, recording where in the binary logs it was taken
+  mysqldump queue --single-transaction --master-data=2 --user=root | gzip > "${set}/full.sql.gz"
+  { zcat "${set}/full.sql.gz" || true; } \
+    | sed -n -e "s/.*MASTER_LOG_FILE='\([^']*\)', MASTER_LOG_POS=\([0-9]*\).*/\1 \2/p" -e "50q" > "${set}/position"
+  if [ ! -s "${set}/position" ]; then
+    echo "Binary logging is off, so incremental backups can't be taken" >&2
+    rm -rf "${set}"
+    exit 1
+  fi
+  mv "${set}" "${backup_dir}/${name}"
+  echo "Started backup set ${name}"
+}
+
+#}}}
+
+# Script proper
+
+mkdir -p "${backup_dir}"
+
+# Close the current binary log, so every change up to now is in a log which can be copied
+sql "FLUSH BINARY LOGS"
+log_dir="$(dirname "$(sql "SELECT @@log_bin_basename")")"
+mapfile -t logs < <(sql "SHOW BINARY LOGS" | cut -f 1)
+current="${logs[-1]}"
+closed=("${logs[@]:0:${#logs[@]}-1}")
+
+newest="$(list_sets | tail -n 1)"
+if [ -z "${newest}" ] || [ -n "$(find "${newest}/full.sql.gz" -mmin +$((full_days * 1440 - 30)))" ]; then
+  newest=""
+elif [ "$(needed_log "${newest}")" \< "${logs[0]}" ]; then
+  echo "Binary logs needed for the newest backup set have been purged, starting a new one" >&2
+  newest=""
+fi
+
+# Copy every closed log into the set whose dump it follows
+for log in "${closed[@]}"; do
+  for set in $(list_sets | sort -r); do
+    if [ ! "${log}" \< "$(cut -d " " -f 1 "${set}/position")" ]; then
+      if [ ! -f "${set}/${log}.gz" ]; then
+        gzip -c "${log_dir}/${log}" > "${set}/.${log}.gz"
+        mv "${set}/.${log}.gz" "${set}/${log}.gz"
+      fi
+      break
+    fi
+  done
+done
+
+if [ -z "${newest}" ]; then
+  full_backup
+fi
+
+# Every change before the current log is now in a backup set
+sql "PURGE BINARY LOGS TO '${current}'"
+
+mapfile -t sets < <(list_sets)
+for set in "${sets[@]:0:$((${#sets[@]} > keep_sets ? ${#sets[@]} - keep_sets : 0))}"; do
+  rm -rf "${set}"
+  echo "Removed backup set $(basename "${set}")"
+done
@@ -28,6 +28,8 @@ CREATE TABLE IF NOT EXISTS `printers` (
   `completed prints` int(10) unsigned DEFAULT 0,
   `failed prints` int(10) unsigned DEFAULT 0,
   `total filament used` float unsigned DEFAULT 0,
+  `supervisor` varchar(64) DEFAULT NULL,
+  `lease expires` datetime DEFAULT NULL,
   PRIMARY KEY (`id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=latin1;
 
@@ -40,10 +42,10 @@ CREATE TABLE IF NOT EXISTS `prints` (
   `gcode filename` tinytext DEFAULT NULL,
   `drive file id` tinytext DEFAULT NULL,
   `filament estimate` float unsigned DEFAULT NULL,
-  `printer type` text DEFAULT NULL,
+  `printer type` varchar(64) DEFAULT NULL,
   `rep check` tinytext DEFAULT NULL,
   `notes` text DEFAULT NULL,
-  `print status` tinytext DEFAULT 'Pending Check',
+  `print status` varchar(32) DEFAULT 'Pending Check',
   `assigned printer` int(11) DEFAULT NULL,
   `expected duration` time DEFAULT NULL,
   `added` datetime DEFAULT current_timestamp(),
@@ -51,9 +53,51 @@ CREATE TABLE IF NOT EXISTS `prints` (
   `start time` datetime DEFAULT NULL,
   `finish time` datetime DEFAULT NULL,
   `completion time` datetime DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `queue order` (`print status`, `printer type`, `added`)
 ) ENGINE=InnoDB AUTO_INCREMENT=7 DEFAULT CHARSET=latin1;
 
+-- Data exporting was unselected.
+-- Dumping structure for table iforge print queue.email outbox
+CREATE TABLE IF NOT EXISTS `email outbox` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `print id` int(11) NOT NULL,
+  `template` varchar(32) NOT NULL,
+  `status` varchar(16) DEFAULT 'Pending',
+  `attempts` int(10) unsigned DEFAULT 0,
+  `next attempt` datetime DEFAULT current_timestamp(),
+  `last error` text DEFAULT NULL,
+  `added` datetime DEFAULT current_timestamp(),
+  `sent` datetime DEFAULT NULL,
+  `claimed by` varchar(32) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `due` (`status`, `next attempt`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- Data exporting was unselected.
+-- Dumping structure for table iforge print queue.supervisors
+CREATE TABLE IF NOT EXISTS `supervisors` (
+  `name` varchar(64) NOT NULL,
+  `heartbeat` datetime DEFAULT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- Data exporting was unselected.
+-- Dumping structure for table iforge print queue.print summaries
+CREATE TABLE IF NOT EXISTS `print summaries` (
+  `period` varchar(8) NOT NULL,
+  `start` date NOT NULL,
+  `printer id` int(11) NOT NULL,
+  `printer type` varchar(64) DEFAULT NULL,
+  `started` int(10) unsigned DEFAULT 0,
+  `completed` int(10) unsigned DEFAULT 0,
+  `failed` int(10) unsigned DEFAULT 0,
+  `print seconds` bigint(20) unsigned DEFAULT 0,
+  `filament used` double unsigned DEFAULT 0,
+  `wait seconds` bigint(20) unsigned DEFAULT 0,
+  PRIMARY KEY (`period`, `start`, `printer id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
 -- Data exporting was unselected.
 /*!40101 SET SQL_MODE=IFNULL(@OLD_SQL_MODE, '') */;
 /*!40014 SET FOREIGN_KEY_CHECKS=IF(@OLD_FOREIGN_KEY_CHECKS IS NULL, 1, @OLD_FOREIGN_KEY_CHECKS) */;
@@ -0,0 +1,56 @@
+-- --------------------------------------------------------
+-- Brings a queue database created from an older template up to date.
+-- Every statement is safe to re-run against an already upgraded database.
+-- --------------------------------------------------------
+
+-- Indexable status and type columns, with an index matching the order prints are claimed in
+ALTER TABLE `prints`
+  MODIFY `printer type` varchar(64) DEFAULT NULL,
+  MODIFY `print status` varchar(32) DEFAULT 'Pending Check',
+  ADD INDEX IF NOT EXISTS `queue order` (`print status`, `printer type`, `added`);
+
+-- Notification emails waiting to be sent by the supervisor's mail worker
+CREATE TABLE IF NOT EXISTS `email outbox` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `print id` int(11) NOT NULL,
+  `template` varchar(32) NOT NULL,
+  `status` varchar(16) DEFAULT 'Pending',
+  `attempts` int(10) unsigned DEFAULT 0,
+  `next attempt` datetime DEFAULT current_timestamp(),
+  `last error` text DEFAULT NULL,
+  `added` datetime DEFAULT current_timestamp(),
+  `sent` datetime DEFAULT NULL,
+  `claimed by` varchar(32) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `due` (`status`, `next attempt`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- Lets the mail workers of several supervisors share the outbox
+ALTER TABLE `email outbox`
+  ADD COLUMN IF NOT EXISTS `claimed by` varchar(32) DEFAULT NULL;
+
+-- Leases sharing the farm between supervisors, and the heartbeats of the supervisors alive
+ALTER TABLE `printers`
+  ADD COLUMN IF NOT EXISTS `supervisor` varchar(64) DEFAULT NULL,
+  ADD COLUMN IF NOT EXISTS `lease expires` datetime DEFAULT NULL;
+
+CREATE TABLE IF NOT EXISTS `supervisors` (
+  `name` varchar(64) NOT NULL,
+  `heartbeat` datetime DEFAULT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- Daily and weekly totals for reports, filled in from the existing history by running Analytics.py
+CREATE TABLE IF NOT EXISTS `print summaries` (
+  `period` varchar(8) NOT NULL,
+  `start` date NOT NULL,
+  `printer id` int(11) NOT NULL,
+  `printer type` varchar(64) DEFAULT NULL,
+  `started` int(10) unsigned DEFAULT 0,
+  `completed` int(10) unsigned DEFAULT 0,
+  `failed` int(10) unsigned DEFAULT 0,
+  `print seconds` bigint(20) unsigned DEFAULT 0,
+  `filament used` double unsigned DEFAULT 0,
+  `wait seconds` bigint(20) unsigned DEFAULT 0,
+  PRIMARY KEY (`period`, `start`, `printer id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
@@ -1,21 +1,55 @@
 import base64
+import datetime
+import email.utils
+import gzip
+import hashlib
 import http.server
+import json
+import logging
+import os
+import re
+import socket
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from http.server import SimpleHTTPRequestHandler
+from queue import Empty, Full, Queue
 from string import Template
+from urllib.parse import parse_qs, urlsplit
 
+import mysql.connector as mariadb
+import requests
 import yaml
+from requests.exceptions import ConnectionError, Timeout
 
 try:
+    import Analytics
+    import Metrics
     import QueueInterface
+    import Supervisor
+    import Telemetry
+    import Webcam
 except ImportError:
+    from app import Analytics
+    from app import Metrics
     from app import QueueInterface
+    from app import Supervisor
+    from app import Telemetry
+    from app import Webcam
 
+global cameras
 global key
+global queue
+global poller
+global registry
+global telemetry
 
 with open('config.yml') as yaml_config:
     config = yaml.safe_load(yaml_config)
 
+requests_served = Metrics.Counter("requests_total", "Requests served, by route")
+sweep_seconds = Metrics.Histogram("status_sweep_seconds", "Time taken to refresh every printer's status")
+
 
 def exec_interval(func, secs):
     """ Execute function repeatedly at given interval. Note: Not accurate! """
@@ -26,73 +60,609 @@ def exec_interval(func, secs):
     timer.start()
 
 
-def update_instances():
-    ips = []
-    apikeys = []
+class StatusPoller(threading.Thread):
+    """Background thread keeping a cached snapshot of every printer's status and the depth of the queue
 
-    # Get printer details from database
-    queue = QueueInterface.QueueInterface()
-    printer_details = queue.get_all_printer_details()
+    Dashboards are served from the snapshot rather than contacting Octoprint themselves, so the load on each Octoprint
+    server stays the same however many dashboards are open. Dashboards can also subscribe to just the changes made at
+    each refresh, rather than fetching the whole snapshot again.
+    """
+
+    def __init__(self, queue, telemetry, interval, workers):
+        """
+        Args:
+            queue: QueueInterface
+                Interface to read queue depths from
+            telemetry: Telemetry.TelemetryStore
+                Store every poll is recorded in
+            interval: float
+                Seconds between refreshes of the snapshot
+            workers: int
+                Maximum number of printers polled at the same time
+        """
+        super().__init__(name="StatusPoller", daemon=True)
+        self.queue = queue
+        self.telemetry = telemetry
+        self.interval = interval
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.printers = {}
+        # Kept already serialised, so serving it costs nothing per request
+        self.snapshot = json.dumps({'updated': None, 'printers': {}, 'queue': {}}).encode()
+        self.last = {'printers': {}, 'queue': {}}
+        # Queues of serialised update events, one for each subscribed dashboard
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def refresh_printers(self, printer_details):
+        """Update the printers being polled to match the database, reusing connections to unchanged printers
+
+        Parameters
+        ----------
+        printer_details: list
+            Rows from QueueInterface.get_all_printer_details
+        """
+        printers = {}
+        for printer in printer_details:
+            if printer[4] is None:
+                continue
+            existing = self.printers.get(printer[0])
+            if existing is not None and existing.url == printer[3] and existing.apikey == printer[4]:
+                existing.name = printer[1]
+                existing.type = printer[2]
+                printers[printer[0]] = existing
+            else:
+                # Connected by the first poll, which runs on the pool with every other printer's
+                printers[printer[0]] = Supervisor.Printer(printer[1], printer[2], printer[3], printer[4],
+                                                          connect=False)
+        self.printers = printers
+
+    def poll(self, printer):
+        """Get the current status of one printer
+
+        Returns
+        -------
+        dict
+            Summary of the printer's state, current job and temperatures
+        """
+        status = {'name': printer.name, 'type': printer.type, 'state': None, 'job': None, 'temperatures': None}
+        if printer.update_state(True):
+            status['temperatures'] = printer.status.get('temperature')
+        status['state'] = printer.state
+        job = printer.get_job_status()
+        if job is not None and job['job']['file']['name'] is not None:
+            status['job'] = {
+                'file': job['job']['file']['name'],
+                'completion': job['progress']['completion'],
+                'time_left': job['progress']['printTimeLeft']
+            }
+        return status
+
+    def run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                # This is the only poller, so keep it going whatever fails - the status would otherwise freeze
+                logging.warning(f"Status sweep failed: {e}")
+            time.sleep(self.interval)
+
+    def sweep(self):
+        """Poll every printer once and publish the results along with the queue depths"""
+        polled = time.time()
+        polls = {printer_id: self.pool.submit(self.poll, printer) for printer_id, printer in self.printers.items()}
+        printers = {}
+        with sweep_seconds.time():
+            for printer_id, poll in polls.items():
+                try:
+                    printers[printer_id] = poll.result()
+                except Exception as e:
+                    logging.warning(f"Polling printer {printer_id} failed: {e}")
+        for printer_id, status in printers.items():
+            try:
+                self.telemetry.record(printer_id, status, polled)
+            except (OSError, ValueError, TypeError) as e:
+                logging.warning(f"Recording telemetry for printer {printer_id} failed: {e}")
+        try:
+            queue_depths = self.queue.get_queue_depths()
+        except Exception as e:
+            logging.warning(f"Reading queue depths failed: {e}")
+            queue_depths = {}
+        self.publish(printers, queue_depths)
+
+    def publish(self, printers, queue_depths):
+        """Replace the snapshot, sending only what changed since the last one to subscribers
+
+        Parameters
+        ----------
+        printers: dict
+            Printer ID: status from poll
+        queue_depths: dict
+            Printer type: number of queued prints
+        """
+        changes = {'printers': {}}
+        for printer_id, status in printers.items():
+            previous = self.last['printers'].get(printer_id)
+            if previous is None:
+                changes['printers'][printer_id] = status
+                continue
+            changed_fields = {field: value for field, value in status.items() if previous[field] != value}
+            if changed_fields:
+                changes['printers'][printer_id] = changed_fields
+        for printer_id in self.last['printers'].keys() - printers.keys():
+            changes['printers'][printer_id] = None
+        if queue_depths != self.last['queue']:
+            changes['queue'] = queue_depths
+        self.last = {'printers': printers, 'queue': queue_depths}
+
+        snapshot = json.dumps({'updated': time.time(), 'printers': printers, 'queue': queue_depths}).encode()
+        event = f"event: update\ndata: {json.dumps(changes)}\n\n".encode()
+        with self.lock:
+            self.snapshot = snapshot
+            if not changes['printers'] and 'queue' not in changes:
+                return
+            for updates in list(self.subscribers):
+                try:
+                    updates.put_nowait(event)
+                except Full:
+                    # Dashboard isn't keeping up, so disconnect it - it will reconnect and start from a fresh snapshot
+                    self.subscribers.discard(updates)
+                    while not updates.empty():
+                        updates.get_nowait()
+                    updates.put_nowait(None)
+
+    def subscribe(self):
+        """Register for changes to the snapshot
+
+        Returns
+        -------
+        tuple
+            (current snapshot, Queue receiving each later change as a serialised event, or None when disconnected)
+        """
+        updates = Queue(maxsize=config["web"]["event_backlog"])
+        with self.lock:
+            self.subscribers.add(updates)
+            return self.snapshot, updates
+
+    def unsubscribe(self, updates):
+        with self.lock:
+            self.subscribers.discard(updates)
+
+
+class StaticFiles:
+    """In-memory cache of the files served from the web folder, with validators and compressed copies worked out once
+
+    Files are read again whenever their modification time or size changes, e.g. when index.js is regenerated.
+    """
+
+    COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def get(self, path, content_type):
+        """Get a file's contents and headers, reading it from disk only if it has changed
+
+        Parameters
+        ----------
+        path: str
+            Path to the file
+        content_type: str
+            MIME type to serve the file as
+
+        Returns
+        -------
+        dict
+            'body', 'gzip' (compressed body, or None if not worth compressing), 'etag', 'last_modified', 'mtime' and
+            'content_type'
+
+        Raises
+        ------
+        OSError
+            If the file can't be read
+        """
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.files.get(path)
+        if entry is None or entry['version'] != (stat.st_mtime_ns, stat.st_size):
+            with open(path, 'rb') as file:
+                body = file.read()
+            compressed = None
+            if content_type.startswith(self.COMPRESSIBLE) and len(body) > 512:
+                compressed = gzip.compress(body)
+            entry = {
+                'version': (stat.st_mtime_ns, stat.st_size),
+                'body': body,
+                'gzip': compressed,
+                'etag': f'"{hashlib.md5(body).hexdigest()}"',
+                'last_modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+                'mtime': int(stat.st_mtime),
+                'content_type': content_type
+            }
+            with self.lock:
+                self.files[path] = entry
+        return entry
+
+
+static_files = StaticFiles()
+
+
+def update_instances():
+    # Get printer details from database, if they've changed since last time
+    printer_details = registry.refresh()
+    if printer_details is None:
+        return
+    printers = []
     for printer in printer_details:
         if printer[4] is not None:
-            ips.append(printer[3]+":80")
-            apikeys.append(printer[4])
+            printers.append({'id': printer[0], 'name': printer[1], 'ip': printer[3] + ":80"})
+    poller.refresh_printers(printer_details)
 
-    subs = {'ips': ips, 'apikeys': apikeys}
+    subs = {'printers': json.dumps(printers)}
 
-    # Substitute placeholders for values and write hosted file
+    # Substitute placeholders for values and write hosted file, unless it's unchanged, e.g. only an API key changed,
+    # so dashboards' cached copies stay valid
     with open("index.js.template", 'r') as template:
         source = Template(template.read())
     result = source.substitute(subs)
-    with open("web/index.js", 'w') as output:
-        output.write(result)
+    try:
+        with open("web/index.js", 'r') as existing:
+            unchanged = existing.read() == result
+    except FileNotFoundError:
+        unchanged = False
+    if not unchanged:
+        with open("web/index.js", 'w') as output:
+            output.write(result)
+    registry.applied()
 
 
 class AuthHandler(SimpleHTTPRequestHandler):
 
+    # Print job commands the dashboard may send to a printer
+    JOB_COMMANDS = {"pause", "cancel"}
+    # Largest request body accepted, far more than any job command needs
+    MAX_BODY = 4096
+    JOB_PATH = re.compile(r"^/api/printers/(\d+)/job$")
+    TELEMETRY_PATH = re.compile(r"^/api/printers/(\d+)/telemetry$")
+    WEBCAM_PATH = re.compile(r"^/api/printers/(\d+)/webcam(/snapshot)?$")
+
+    # Keep connections open between requests, which needs every response to give its length
+    protocol_version = "HTTP/1.1"
+    # Seconds before an idle connection is closed, so open connections don't hold threads forever
+    timeout = 120
+    # Headers and body are written separately, which Nagle's algorithm would hold up waiting for a delayed ACK
+    disable_nagle_algorithm = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory="web", **kwargs)
 
     def do_HEAD(self):
         self.send_response(200)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
-    def do_AUTHHEAD(self):
+    def do_AUTHHEAD(self, body=b""):
         self.send_response(401)
         self.send_header('WWW-Authenticate', 'Basic realm=\"Test\"')
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
 
-    def do_GET(self):
+    def authorised(self):
+        """Check the request's credentials, responding with an authentication challenge if they're missing or wrong"""
         global key
         if self.headers.get('Authorization') is None:
-            self.do_AUTHHEAD()
-            self.wfile.write('no auth header received'.encode())
-            pass
+            self.do_AUTHHEAD('no auth header received'.encode())
+            return False
         elif self.headers.get('Authorization') == f"Basic {key.decode('utf-8')}":
-            SimpleHTTPRequestHandler.do_GET(self)
-            pass
+            return True
         else:
-            self.do_AUTHHEAD()
-            self.wfile.write(self.headers.get('Authorization').encode())
-            self.wfile.write('not authenticated'.encode())
+            self.do_AUTHHEAD(self.headers.get('Authorization').encode() + 'not authenticated'.encode())
+            return False
+
+    def send_json(self, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, entry):
+        """Check whether the client's cached copy of a file is still current"""
+        if self.headers.get('If-None-Match') is not None:
+            etags = [etag.strip() for etag in self.headers.get('If-None-Match').split(',')]
+            return entry['etag'] in etags or '*' in etags
+        if self.headers.get('If-Modified-Since') is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers.get('If-Modified-Since'))
+            except (TypeError, ValueError):
+                return False
+            return since is not None and entry['mtime'] <= since.timestamp()
+        return False
+
+    def send_static(self):
+        """Serve a file from the web folder out of memory, compressed if the client accepts it"""
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.html")
+        try:
+            entry = static_files.get(path, self.guess_type(path))
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        if self.not_modified(entry):
+            self.send_response(304)
+            self.send_header('ETag', entry['etag'])
+            self.end_headers()
+            return
+        compressed = entry['gzip'] is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = entry['gzip'] if compressed else entry['body']
+        self.send_response(200)
+        self.send_header('Content-type', entry['content_type'])
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', entry['etag'])
+        self.send_header('Last-Modified', entry['last_modified'])
+        # Always check back, but the validators make that cheap while the file hasn't changed
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self):
+        """Stream the status snapshot followed by each change to it as server-sent events, until the client leaves"""
+        snapshot, updates = poller.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            # The stream has no length, so it ends when the connection closes
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b"event: snapshot\ndata: " + snapshot + b"\n\n")
+            while True:
+                try:
+                    event = updates.get(timeout=config["web"]["event_keepalive"])
+                except Empty:
+                    # Comment line, stopping proxies and browsers from timing out an idle connection
+                    event = b": keepalive\n\n"
+                if event is None:
+                    break
+                self.wfile.write(event)
+        except (BrokenPipeError, ConnectionResetError):
             pass
+        finally:
+            poller.unsubscribe(updates)
+            self.close_connection = True
+
+    def send_telemetry(self, printer_id, query):
+        """Serve a printer's telemetry, over the last hour unless start and end are given as unix times
+
+        A resolution in seconds can be given to get averaged samples rather than every one, e.g. for long ranges.
+        """
+        try:
+            end = float(query.get('end', [time.time()])[0])
+            start = float(query.get('start', [end - 3600])[0])
+            resolution = float(query.get('resolution', [0])[0])
+        except ValueError:
+            self.send_json(b'{"error": "Invalid range"}', 400)
+            return
+        if printer_id not in poller.printers:
+            self.send_json(b'{"error": "Unknown printer"}', 404)
+            return
+        self.send_json(json.dumps(telemetry.query(printer_id, start, end, resolution)).encode())
+
+    def send_webcam(self, printer_id, query):
+        """Relay a printer's webcam stream, sharing one connection to the camera between every viewer
+
+        An fps query parameter limits the frame rate sent, e.g. for small views of many cameras.
+        """
+        try:
+            fps = float(query.get('fps', [0])[0])
+        except ValueError:
+            self.send_json(b'{"error": "Invalid frame rate"}', 400)
+            return
+        printer = poller.printers.get(printer_id)
+        if printer is None:
+            self.send_json(b'{"error": "Unknown printer"}', 404)
+            return
+        with cameras.get(printer_id, printer.url).watch() as relay:
+            sequence, frame = relay.wait_frame()
+            if frame is None:
+                self.send_json(b'{"error": "Webcam unavailable"}', 502)
+                return
+            try:
+                self.send_response(200)
+                self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=frame')
+                self.send_header('Cache-Control', 'no-cache')
+                # The stream has no length, so it ends when the connection closes
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                while frame is not None:
+                    self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n"
+                                     % (len(frame), frame))
+                    Webcam.frames_relayed.inc(direction="sent")
+                    if fps > 0:
+                        time.sleep(1 / fps)
+                    # Always the newest frame, so a slow viewer skips frames rather than falling behind
+                    sequence, frame = relay.wait_frame(sequence)
+            except (BrokenPipeError, ConnectionResetError, socket.timeout):
+                pass
+            finally:
+                self.close_connection = True
+
+    def send_snapshot(self, printer_id, query):
+        """Serve the newest frame from a printer's webcam, scaled down if a width is given"""
+        try:
+            width = int(query.get('width', [0])[0])
+        except ValueError:
+            width = -1
+        if width < 0:
+            self.send_json(b'{"error": "Invalid width"}', 400)
+            return
+        printer = poller.printers.get(printer_id)
+        if printer is None:
+            self.send_json(b'{"error": "Unknown printer"}', 404)
+            return
+        relay = cameras.get(printer_id, printer.url)
+        try:
+            image = relay.thumbnail(width) if width else relay.wait_frame()[1]
+        except OSError as e:
+            logging.warning(f"Scaling webcam frame from printer {printer_id} failed: {e}")
+            image = None
+        if image is None:
+            self.send_json(b'{"error": "Webcam unavailable"}', 502)
+            return
+        self.send_response(200)
+        self.send_header('Content-type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(image)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(image)
+
+    def send_analytics(self, query):
+        """Serve a report on the prints started and finished each day or week
+
+        Query parameters are period ("day" or "week"), by ("printer" or "type"), and start and end as ISO dates,
+        covering the last few weeks if not given.
+        """
+        try:
+            period = query.get('period', ["day"])[0]
+            group = query.get('by', ["printer"])[0]
+            end = datetime.date.fromisoformat(query.get('end', [datetime.date.today().isoformat()])[0])
+            start = datetime.date.fromisoformat(query.get('start', [
+                (end - datetime.timedelta(days=config['analytics']['default_days'])).isoformat()])[0])
+        except ValueError:
+            self.send_json(b'{"error": "Invalid range"}', 400)
+            return
+        if period not in Analytics.PERIODS or group not in Analytics.GROUPS:
+            self.send_json(b'{"error": "Invalid period or grouping"}', 400)
+            return
+        try:
+            report = queue.get_report(period, start, end, group)
+        except mariadb.Error as e:
+            logging.warning(f"Reading analytics failed: {e}")
+            self.send_json(b'{"error": "Queue database unavailable"}', 503)
+            return
+        self.send_json(json.dumps({'period': period, 'by': group, 'start': start.isoformat(), 'end': end.isoformat(),
+                                   'rows': report}).encode())
+
+    def send_metrics(self):
+        """Serve the metrics of this process and the supervisor's together, for Prometheus to scrape"""
+        body = Metrics.registry.render()
+        try:
+            body += requests.get(f"http://127.0.0.1:{config['metrics']['supervisor_port']}/metrics", timeout=2).content
+        except (ConnectionError, Timeout) as e:
+            logging.warning(f"Couldn't fetch supervisor metrics: {e}")
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.authorised():
+            return
+        url = urlsplit(self.path)
+        telemetry_match = self.TELEMETRY_PATH.match(url.path)
+        webcam_match = self.WEBCAM_PATH.match(url.path)
+        if url.path == "/api/status":
+            requests_served.inc(route="status")
+            self.send_json(poller.snapshot)
+        elif url.path == "/api/events":
+            requests_served.inc(route="events")
+            self.send_events()
+        elif telemetry_match:
+            requests_served.inc(route="telemetry")
+            self.send_telemetry(int(telemetry_match.group(1)), parse_qs(url.query))
+        elif webcam_match and webcam_match.group(2):
+            requests_served.inc(route="snapshot")
+            self.send_snapshot(int(webcam_match.group(1)), parse_qs(url.query))
+        elif webcam_match:
+            requests_served.inc(route="webcam")
+            self.send_webcam(int(webcam_match.group(1)), parse_qs(url.query))
+        elif url.path == "/api/analytics":
+            requests_served.inc(route="analytics")
+            self.send_analytics(parse_qs(url.query))
+        elif url.path == "/metrics":
+            requests_served.inc(route="metrics")
+            self.send_metrics()
+        else:
+            requests_served.inc(route="static")
+            self.send_static()
+
+    def do_POST(self):
+        """Pass print job commands from the dashboard on to a printer, so API keys never reach the browser"""
+        if not self.authorised():
+            # The body hasn't been read, so the connection can't be used for another request
+            self.close_connection = True
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.close_connection = True
+            self.send_json(b'{"error": "Invalid Content-Length"}', 400)
+            return
+        if length > self.MAX_BODY:
+            self.close_connection = True
+            self.send_json(b'{"error": "Request too large"}', 413)
+            return
+        # The body is always read, so nothing is left over for the next request on the connection
+        body = self.rfile.read(length)
+        requests_served.inc(route="job")
+        match = self.JOB_PATH.match(self.path)
+        printer = poller.printers.get(int(match.group(1))) if match else None
+        if printer is None or printer.client is None:
+            self.send_json(b'{"error": "Unknown printer"}', 404)
+            return
+        try:
+            command = json.loads(body)
+        except ValueError:
+            command = None
+        if not isinstance(command, dict) or command.get('command') not in self.JOB_COMMANDS:
+            self.send_json(b'{"error": "Invalid command"}', 400)
+            return
+        try:
+            response = printer.client.session.post(f"{printer.client.url}/api/job", json=command)
+        except (ConnectionError, Timeout):
+            self.send_json(b'{"error": "Printer offline"}', 502)
+            return
+        self.send_json(json.dumps({'status': response.status_code}).encode(), 200 if response.ok else 502)
 
 
 def run(port=8000):
-    # Host web server
+    # Host web server, handling each connection in its own thread as event streams stay open indefinitely
     server_address = ('', port)
-    httpd = http.server.HTTPServer(server_address, AuthHandler)
+    httpd = http.server.ThreadingHTTPServer(server_address, AuthHandler)
     sa = httpd.socket.getsockname()
     print("Serving HTTP on", sa[0], "port", sa[1], "...")
     httpd.serve_forever()
 
 
 if __name__ == '__main__':
+    Metrics.limit_logging(config['metrics'])
+    Metrics.registry.prefix = "web"
+    # Single queue interface reused for every update, sharing the database connection pool
+    queue = QueueInterface.QueueInterface()
+    # Printers table, only read again when it changes
+    registry = Supervisor.PrinterRegistry(queue)
+    # History of every printer's status, recorded locally by the poller
+    telemetry = Telemetry.TelemetryStore(config["telemetry"]["directory"], config["telemetry"]["levels"],
+                                         config["telemetry"]["transitions"])
+    # Connections to printers' webcams, each shared by everyone watching it
+    cameras = Webcam.CameraRelays(config["webcam"])
+    # Shared printer status, refreshed in the background for all dashboards
+    poller = StatusPoller(queue, telemetry, config["web"]["status_interval"], config["supervisor"]["poll_workers"])
     # Initial js file creation
     update_instances()
-    # 1 hour between major js file updates - still requires user to refresh page on client side
+    poller.start()
+    # Check the printers table for changes every update_interval, only rewriting the js file when they show in it -
+    # dashboards already open still need refreshing to pick it up
     exec_interval(update_instances, config["web"]["update_interval"])
     # Set up authentication and start server
     username = config["web"]["username"]
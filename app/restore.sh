@@ -0,0 +1,60 @@
+#!/bin/bash
+#
+# Restore the queue database from a backup set taken by backup.sh
+#
+# The set's full dump is loaded, then every change in its binary logs is replayed on top. mysqlbinlog can't read
+# compressed logs, so they are unpacked into a temporary folder first, which needs free space for the whole set's logs
+# uncompressed - set TMPDIR to unpack them elsewhere. Uses the newest set unless another is named, e.g.
+# restore.sh PASSWORD 20200106-030000
+
+set -o errexit
+set -o nounset
+set -o pipefail
+
+if [ "$#" -lt "1" ] || [ "$#" -gt "2" ]; then
+  echo "Expected 1 or 2 arguments, got $#" >&2
+  exit 2
+fi
+
+#{{{ Variables
+export MYSQL_PWD="${1}"
+backup_dir="${BACKUP_DIR:-/data/backups}"
+#}}}
+
+# Script proper
+
+if [ "$#" -eq "2" ]; then
+  set="${backup_dir}/${2}"
+else
+  set="$(find "${backup_dir}" -mindepth 1 -maxdepth 1 -type d -name "20*" | sort | tail -n 1)"
+fi
+if [ -z "${set}" ] || [ ! -f "${set}/full.sql.gz" ]; then
+  echo "No backup set to restore" >&2
+  exit 1
+fi
+
+read -r start_log start_position < "${set}/position"
+mapfile -t logs < <(find "${set}" -maxdepth 1 -name "*.[0-9]*.gz" -printf "%f\n" | sort)
+
+# The restore itself shouldn't be written to the binary logs, or it would end up in the next backup set twice
+echo "Restoring $(basename "${set}")"
+{ echo "SET sql_log_bin = 0;"; zcat "${set}/full.sql.gz"; } | mysql --user=root queue
+
+if [ "${#logs[@]}" -gt "0" ]; then
+  # mysqlbinlog needs seekable files, and replays the logs in one run so nothing spanning two of them is lost
+  scratch="$(mktemp -d)"
+  trap 'rm -rf "${scratch}"' EXIT
+  for log in "${logs[@]}"; do
+    zcat "${set}/${log}" > "${scratch}/${log%.gz}"
+  done
+  files=("${logs[@]/#/${scratch}/}")
+  files=("${files[@]%.gz}")
+  if [ "${logs[0]%.gz}" = "${start_log}" ]; then
+    # Only the changes made after the dump was taken
+    replay=(--start-position="${start_position}")
+  else
+    replay=()
+  fi
+  { echo "SET sql_log_bin = 0;"; mysqlbinlog "${replay[@]}" --database=queue "${files[@]}"; } | mysql --user=root queue
+  echo "Replayed ${#logs[@]} binary logs"
+fi